@@ -0,0 +1,70 @@
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import server
+
+queries = {
+    'get_items_in_container': ('SELECT items.* FROM items INNER JOIN containers ON items.barcode_id = containers.item_id WHERE container_id = :id', 'container'),
+    'get_full_container_path_of_item': ('SELECT container_id FROM containers WHERE item_id = :id', 'item'),
+    'get_full_location_of_item': ('SELECT container_id FROM vehicles WHERE item_id = :id', 'item'),
+    'get_last_outstanding_checkout': ('SELECT toolshed_checkouts.* FROM toolshed_checkouts LEFT JOIN toolshed_checkins ON toolshed_checkouts.checkout_id = toolshed_checkins.checkout_id WHERE toolshed_checkins.checkout_id IS NULL AND toolshed_checkouts.item_id = :id AND toolshed_checkouts.checkout_id = (SELECT checkout_id FROM toolshed_checkouts WHERE item_id = :id ORDER BY unix_time DESC LIMIT 1)', 'item'),
+    'get_items_checked_out_by_user': ('SELECT items.* FROM toolshed_checkouts LEFT JOIN toolshed_checkins ON toolshed_checkouts.checkout_id = toolshed_checkins.checkout_id INNER JOIN items ON toolshed_checkouts.item_id = items.barcode_id WHERE toolshed_checkins.checkout_id IS NULL AND toolshed_checkouts.user_id = :id', 'user'),
+    'latest_user_checkin': ('SELECT max(unix_time) FROM user_checkins WHERE user_id = :id', 'user'),
+}
+
+def populate(con, rows):
+    rng = random.Random(0)
+    item_ids = [f'item-{i}' for i in range(rows)]
+    user_ids = [f'user-{i}' for i in range(rows // 100)]
+    container_ids = item_ids[:rows // 20]
+    con.executemany('INSERT INTO items (barcode_id, short_id, name) VALUES (?, ?, ?)', ((item_id, str(i), f'Item {i}') for i, item_id in enumerate(item_ids)))
+    con.executemany('INSERT INTO users (barcode_id, name) VALUES (?, ?)', ((user_id, user_id) for user_id in user_ids))
+    con.executemany('INSERT INTO containers (container_id, item_id) VALUES (?, ?)', ((rng.choice(container_ids), item_id) for item_id in item_ids[rows // 20:]))
+    con.executemany('INSERT INTO vehicles (container_id, item_id) VALUES (?, ?)', ((rng.choice(container_ids), item_id) for item_id in container_ids))
+    con.executemany('INSERT INTO user_checkins (user_id, unix_time) VALUES (?, ?)', ((rng.choice(user_ids), t) for t in range(rows)))
+    con.executemany('INSERT INTO user_checkouts (user_id, unix_time) VALUES (?, ?)', ((rng.choice(user_ids), t) for t in range(rows)))
+    con.executemany('INSERT INTO toolshed_checkouts (item_id, user_id, unix_time) VALUES (?, ?, ?)', ((rng.choice(item_ids), rng.choice(user_ids), t) for t in range(rows)))
+    con.executemany('INSERT INTO toolshed_checkins (checkout_id, item_id, user_id, unix_time) SELECT checkout_id, item_id, user_id, unix_time + 1 FROM toolshed_checkouts WHERE checkout_id % 10 != 0', ())
+    con.commit()
+    return {'item': item_ids, 'user': user_ids, 'container': container_ids}
+
+def time_queries(con, ids, iterations):
+    rng = random.Random(1)
+    timings = {}
+    for name, (query, id_kind) in queries.items():
+        start = time.perf_counter()
+        for _ in range(iterations):
+            con.execute(query, {'id': rng.choice(ids[id_kind])}).fetchall()
+        timings[name] = (time.perf_counter() - start) / iterations
+    return timings
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare hot query latency before and after the schema index migrations.')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        db_name = os.path.join(directory, 'items.db')
+        con = sqlite3.connect(db_name)
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'create_db.sql')) as schema:
+            con.executescript(schema.read())
+        ids = populate(con, args.rows)
+        before = time_queries(con, ids, args.iterations)
+        con.close()
+        server.migrate_db(db_name)
+        con = sqlite3.connect(db_name)
+        after = time_queries(con, ids, args.iterations)
+        print(f'{"query":<36}{"before (ms)":>14}{"after (ms)":>14}{"speedup":>10}')
+        for name in queries:
+            print(f'{name:<36}{before[name] * 1000:>14.3f}{after[name] * 1000:>14.3f}{before[name] / after[name]:>9.0f}x')
+        for name, (query, _) in queries.items():
+            print(f'\n{name}:')
+            for row in con.execute('EXPLAIN QUERY PLAN ' + query, {'id': ''}):
+                print(f'    {row[-1]}')
+        con.close()
@@ -0,0 +1,43 @@
+import argparse
+import os
+import sys
+import time
+
+from flask import jsonify
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import server
+
+def make_rows(rows):
+    return [(f'item-{i}', str(i), f'Item {i}', f'{i % 256:02x}/{i % 251:02x}/{i:064x}', None if i % 3 else f'Description of item {i}') for i in range(rows)]
+
+def time_call(func, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        body = func()
+    return (time.perf_counter() - start) / iterations, body
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare dataclass + jsonify serialization against the direct row serializer.')
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--iterations', type=int, default=5)
+    args = parser.parse_args()
+    rows = make_rows(args.rows)
+    accelerated = server.orjson
+    paths = [
+        ('dataclass + jsonify', accelerated, lambda: jsonify([server.Item(*row) for row in rows]).get_data()),
+        ('rows (json)', None, lambda: server.rows_response(server.Item, rows).get_data()),
+    ]
+    if accelerated is not None:
+        paths.append(('rows (orjson)', accelerated, lambda: server.rows_response(server.Item, rows).get_data()))
+    timings = {}
+    bodies = {}
+    with server.app.app_context():
+        for name, encoder, func in paths:
+            server.orjson = encoder
+            timings[name], bodies[name] = time_call(func, args.iterations)
+    server.orjson = accelerated
+    baseline = timings['dataclass + jsonify']
+    print(f'{"path":<24}{"time (ms)":>12}{"speedup":>10}{"identical":>12}')
+    for name, duration in timings.items():
+        print(f'{name:<24}{duration * 1000:>12.1f}{baseline / duration:>9.1f}x{str(bodies[name] == bodies["dataclass + jsonify"]):>12}')
@@ -0,0 +1,153 @@
+import argparse
+import http.client
+import os
+import random
+import ssl
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import server
+import dataset
+
+api = '/inventory/api/v1.0'
+
+# (weight, name, id kind, request builder); weights follow a day on site, where
+# scans and badge check-ins dominate and supervisors pull the occasional report.
+scenarios = [
+    (20, 'get_item', 'item', lambda item_id: ('GET', f'{api}/items/{item_id}', None)),
+    (10, 'get_full_location_of_item', 'item', lambda item_id: ('GET', f'{api}/full-location/{item_id}', None)),
+    (8, 'get_parent_of_item', 'item', lambda item_id: ('GET', f'{api}/item-parent/{item_id}', None)),
+    (8, 'get_user', 'user', lambda user_id: ('GET', f'{api}/users/{user_id}', None)),
+    (6, 'get_registered_device_id', 'device', lambda android_id: ('GET', f'{api}/registered-devices/{android_id}', None)),
+    (6, 'get_items_in_container', 'container', lambda container_id: ('GET', f'{api}/containers/{container_id}', None)),
+    (2, 'get_items_in_vehicles', 'vehicle', lambda container_id: ('GET', f'{api}/vehicles/{container_id}', None)),
+    (2, 'get_items_in_location', 'location', lambda container_id: ('GET', f'{api}/locations/{container_id}', None)),
+    (6, 'get_last_outstanding_checkout', 'item', lambda item_id: ('GET', f'{api}/toolshed-checkout/{item_id}/last-outstanding', None)),
+    (4, 'get_items_checked_out_by_user', 'user', lambda user_id: ('GET', f'{api}/users/{user_id}/toolshed-checkout-outstanding', None)),
+    (4, 'get_checked_in_users', None, lambda _: ('GET', f'{api}/users-checkedin/', None)),
+    (1, 'get_users_with_outstanding_toolshed_checkouts', None, lambda _: ('GET', f'{api}/users-toolshed-checkout-outstanding', None)),
+    (4, 'get_item_pictures', 'item', lambda item_id: ('GET', f'{api}/item-picture/{item_id}', None)),
+    (4, 'search', 'item', lambda item_id: ('GET', f'{api}/search?q={item_id[:-2]}', None)),
+    (1, 'get_items', None, lambda _: ('GET', f'{api}/items?limit=500', None)),
+    (1, 'get_inventory_event_summary', 'inventory_event', lambda inventory_id: ('GET', f'{api}/inventory-events/{inventory_id}/summary', None)),
+    (1, 'get_all_not_good_inventoried_items', 'inventory_event', lambda inventory_id: ('GET', f'{api}/inventoried-items-not-good/{inventory_id}', None)),
+    (6, 'checkin_user', 'user', lambda user_id: ('POST', f'{api}/user-checkin/{user_id}', None)),
+    (6, 'checkout_user', 'user', lambda user_id: ('POST', f'{api}/user-checkout/{user_id}', None)),
+    (3, 'add_inventoried_item', 'item', lambda item_id: ('POST', f'{api}/inventoried-items', {'inventory_id': 1, 'item_id': item_id, 'status': 'GOOD'})),
+]
+
+def choose_request(rng, ids, enabled):
+    weights = [weight for weight, name, _, _ in scenarios if name in enabled]
+    candidates = [scenario for scenario in scenarios if scenario[1] in enabled]
+    _, name, id_kind, build = rng.choices(candidates, weights)[0]
+    return name, build(None if id_kind is None else rng.choice(ids[id_kind]))
+
+class ClientTransport:
+    def __init__(self, auth):
+        self.client = server.app.test_client()
+        self.headers = {'Authorization': auth}
+
+    def send(self, method, path, body):
+        response = self.client.open(path, method=method, headers=self.headers, json=body)
+        response.get_data()
+        return response.status_code
+
+class HttpTransport:
+    def __init__(self, url, auth, insecure):
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme == 'https':
+            context = ssl._create_unverified_context() if insecure else ssl.create_default_context()
+            self.connection = http.client.HTTPSConnection(parsed.netloc, context=context)
+        else:
+            self.connection = http.client.HTTPConnection(parsed.netloc)
+        self.prefix = parsed.path.rstrip('/')
+        self.auth = auth
+
+    def send(self, method, path, body):
+        headers = {'Authorization': self.auth}
+        if body is not None:
+            body = server.json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        self.connection.request(method, self.prefix + path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+        return response.status
+
+def run_worker(transport, ids, enabled, seed, deadline, results):
+    rng = random.Random(seed)
+    while time.monotonic() < deadline:
+        name, (method, path, body) = choose_request(rng, ids, enabled)
+        start = time.perf_counter()
+        try:
+            status = transport.send(method, path, body)
+        except Exception:
+            status = None
+        results.append((name, time.perf_counter() - start, status))
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+def report(results, elapsed):
+    by_name = {}
+    for name, duration, status in results:
+        by_name.setdefault(name, []).append((duration, status))
+    print(f'{"endpoint":<48}{"requests":>10}{"errors":>8}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for name, samples in sorted(by_name.items()):
+        durations = sorted(duration for duration, _ in samples)
+        errors = sum(1 for _, status in samples if status is None or status >= 400)
+        print(f'{name:<48}{len(samples):>10}{errors:>8}{len(samples) / elapsed:>10.1f}'
+                f'{percentile(durations, 0.5) * 1000:>10.2f}{percentile(durations, 0.95) * 1000:>10.2f}{percentile(durations, 0.99) * 1000:>10.2f}')
+    print(f'{"total":<48}{len(results):>10}{"":>8}{len(results) / elapsed:>10.1f}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drive the inventory routes with a weighted request mix and report latency percentiles.')
+    parser.add_argument('--db', help='Use an existing database (see dataset.py) instead of generating a scratch one.')
+    parser.add_argument('--pictures', help='Picture directory that belongs to --db.')
+    parser.add_argument('--url', help='Load test a running server (e.g. https://localhost:5000) instead of the in-process test client.')
+    parser.add_argument('--auth', default='benchmark', help='Authorization header value.')
+    parser.add_argument('--insecure', action='store_true', help='Skip TLS certificate verification in --url mode.')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds to run.')
+    parser.add_argument('--read-only', action='store_true', help='Skip the write routes.')
+    parser.add_argument('--only', help='Comma-separated endpoint names to run.')
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--years', type=int, default=2)
+    parser.add_argument('--inventory-events', type=int, default=4)
+    args = parser.parse_args()
+    enabled = {name for _, name, _, _ in scenarios}
+    if args.only is not None:
+        enabled &= set(args.only.split(','))
+    if args.read_only:
+        enabled = {name for _, name, _, build in scenarios if name in enabled and build('x')[0] == 'GET'}
+    with tempfile.TemporaryDirectory() as directory:
+        if args.db is None:
+            db_name = os.path.join(directory, 'items.db')
+            pictures = os.path.join(directory, 'pictures')
+            os.mkdir(pictures)
+            print('Generating dataset...', file=sys.stderr)
+            ids = dataset.generate(db_name, pictures, args.items, args.users, args.years, args.inventory_events)
+        else:
+            db_name, pictures = args.db, args.pictures
+            ids = dataset.load_ids(db_name)
+        if args.url is None:
+            server.db_name = db_name
+            server.picture_directory = pictures
+            server.auth_value = args.auth.encode()
+            server.migrate_db(db_name)
+            transports = [ClientTransport(args.auth) for _ in range(args.concurrency)]
+        else:
+            transports = [HttpTransport(args.url, args.auth, args.insecure) for _ in range(args.concurrency)]
+        results = []
+        start = time.monotonic()
+        deadline = start + args.duration
+        threads = [threading.Thread(target=run_worker, args=(transport, ids, enabled, seed, deadline, results)) for seed, transport in enumerate(transports)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        report(results, time.monotonic() - start)
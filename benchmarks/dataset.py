@@ -0,0 +1,119 @@
+import argparse
+import hashlib
+import os
+import random
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import server
+
+day_seconds = 24 * 60 * 60
+statuses = [status.value for status in server.InventoryStatus]
+status_weights = [90, 3, 3, 1, 2, 1]
+
+def create_picture(picture_directory):
+    # Every generated item and user shares one small picture, so picture routes
+    # exercise the real file-serving path without generating a file per row.
+    content = b'\xff\xd8\xff\xe0benchmark picture\xff\xd9'
+    picture_path = server.content_addressed_picture_path(hashlib.sha256(content).hexdigest())
+    full_picture_path = os.path.join(picture_directory, picture_path)
+    os.makedirs(os.path.dirname(full_picture_path), exist_ok=True)
+    with open(full_picture_path, 'wb') as picture:
+        picture.write(content)
+    return picture_path
+
+def generate(db_name, picture_directory, items=20000, users=500, years=2, inventory_events=4, seed=0):
+    rng = random.Random(seed)
+    picture_path = create_picture(picture_directory)
+    con = sqlite3.connect(db_name)
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'create_db.sql')) as schema:
+        con.executescript(schema.read())
+    item_ids = [f'item-{i:06d}' for i in range(items)]
+    user_ids = [f'user-{i:05d}' for i in range(users)]
+    location_ids = item_ids[:max(items // 1000, 1)]
+    vehicle_ids = item_ids[len(location_ids):len(location_ids) + max(items // 400, 1)]
+    container_ids = item_ids[len(location_ids) + len(vehicle_ids):len(location_ids) + len(vehicle_ids) + max(items // 20, 1)]
+    loose_ids = item_ids[len(location_ids) + len(vehicle_ids) + len(container_ids):]
+    con.executemany('INSERT INTO items (barcode_id, short_id, name, picture_path, description) VALUES (?, ?, ?, ?, ?)',
+            ((item_id, str(i), f'Item {i}', picture_path, None if i % 4 else f'Description of item {i}') for i, item_id in enumerate(item_ids)))
+    con.executemany('INSERT INTO users (barcode_id, name, company, picture_path, user_type, description, initial_checkin_info) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ((user_id, f'User {i}', f'Company {i % 12}', picture_path, 'worker' if i % 10 else 'supervisor', None, None) for i, user_id in enumerate(user_ids)))
+    con.executemany('INSERT INTO registered_devices (android_id, barcode_id) VALUES (?, ?)',
+            ((f'device-{i:04d}', user_id) for i, user_id in enumerate(user_ids[:max(users // 10, 1)])))
+    # Vehicles park at locations, a third of the containers ride in vehicles,
+    # the rest sit at locations or nest up to three deep inside other containers.
+    con.executemany('INSERT INTO locations (container_id, item_id) VALUES (?, ?)', ((rng.choice(location_ids), vehicle_id) for vehicle_id in vehicle_ids))
+    top_level_containers = container_ids[:len(container_ids) // 3]
+    nested_containers = container_ids[len(container_ids) // 3:]
+    con.executemany('INSERT INTO vehicles (container_id, item_id) VALUES (?, ?)', ((rng.choice(vehicle_ids), container_id) for container_id in top_level_containers[::2]))
+    con.executemany('INSERT INTO locations (container_id, item_id) VALUES (?, ?)', ((rng.choice(location_ids), container_id) for container_id in top_level_containers[1::2]))
+    parents = list(top_level_containers)
+    for depth_containers in (nested_containers[:len(nested_containers) // 2], nested_containers[len(nested_containers) // 2:]):
+        con.executemany('INSERT INTO containers (container_id, item_id) VALUES (?, ?)', ((rng.choice(parents), container_id) for container_id in depth_containers))
+        parents = depth_containers or parents
+    con.executemany('INSERT INTO containers (container_id, item_id) VALUES (?, ?)', ((rng.choice(container_ids), item_id) for item_id in loose_ids))
+    # Roughly 250 working days a year; most users check in each morning and
+    # out each afternoon, and the toolshed lends a few hundred tools a day.
+    start_time = 1700000000 - years * 365 * day_seconds
+    workdays = [start_time + day * day_seconds for day in range(years * 365) if day % 7 < 5]
+    user_checkins = []
+    user_checkouts = []
+    toolshed_checkouts = []
+    for day_time in workdays:
+        for user_id in rng.sample(user_ids, int(users * 0.6)):
+            checkin_time = day_time + 6 * 3600 + rng.randrange(3600)
+            user_checkins.append((user_id, checkin_time))
+            user_checkouts.append((user_id, checkin_time + 8 * 3600 + rng.randrange(3600)))
+        for _ in range(max(users // 2, 1)):
+            toolshed_checkouts.append((rng.choice(loose_ids or item_ids), rng.choice(user_ids), day_time + 7 * 3600 + rng.randrange(8 * 3600)))
+    last_day = workdays[-1] if workdays else start_time
+    # Leave the most recent day's shift checked in.
+    user_checkouts = [checkout for checkout in user_checkouts if checkout[1] < last_day]
+    con.executemany('INSERT INTO user_checkins (user_id, unix_time) VALUES (?, ?)', user_checkins)
+    con.executemany('INSERT INTO user_checkouts (user_id, unix_time) VALUES (?, ?)', user_checkouts)
+    con.executemany('INSERT INTO toolshed_checkouts (item_id, user_id, unix_time) VALUES (?, ?, ?)', sorted(toolshed_checkouts, key=lambda checkout: checkout[2]))
+    con.execute('INSERT INTO toolshed_checkins (checkout_id, item_id, user_id, unix_time) \
+            SELECT checkout_id, item_id, user_id, unix_time + 3600 FROM toolshed_checkouts WHERE checkout_id % 50 != 0 AND unix_time < :last_day', {'last_day': last_day})
+    for event in range(inventory_events):
+        event_time = start_time + (event + 1) * (years * 365 * day_seconds) // (inventory_events + 1)
+        complete_time = None if event == inventory_events - 1 else event_time + 3 * day_seconds
+        inventory_id = con.execute('INSERT INTO inventory_events (start_unix_time, complete_unix_time) VALUES (?, ?)', (event_time, complete_time)).lastrowid
+        counted = rng.sample(item_ids, int(items * (0.6 if complete_time is None else 0.97)))
+        con.executemany('INSERT INTO inventoried_items (inventory_id, item_id, status, notes) VALUES (?, ?, ?, ?)',
+                ((inventory_id, item_id, status, None if status == 'GOOD' else 'benchmark') for item_id, status in zip(counted, rng.choices(statuses, status_weights, k=len(counted)))))
+    con.commit()
+    con.close()
+    server.migrate_db(db_name)
+    return load_ids(db_name)
+
+def load_ids(db_name):
+    con = sqlite3.connect(db_name)
+    try:
+        ids = {
+            'item': [row[0] for row in con.execute('SELECT barcode_id FROM items')],
+            'user': [row[0] for row in con.execute('SELECT barcode_id FROM users')],
+            'container': [row[0] for row in con.execute('SELECT DISTINCT container_id FROM containers')],
+            'vehicle': [row[0] for row in con.execute('SELECT DISTINCT container_id FROM vehicles')],
+            'location': [row[0] for row in con.execute('SELECT DISTINCT container_id FROM locations')],
+            'device': [row[0] for row in con.execute('SELECT android_id FROM registered_devices')],
+            'inventory_event': [row[0] for row in con.execute('SELECT id FROM inventory_events')],
+        }
+    finally:
+        con.close()
+    return ids
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic construction-site database for benchmarks and load tests.')
+    parser.add_argument('db_name')
+    parser.add_argument('picture_directory')
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--years', type=int, default=2)
+    parser.add_argument('--inventory-events', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if os.path.exists(args.db_name):
+        sys.exit(f'{args.db_name} already exists')
+    os.makedirs(args.picture_directory, exist_ok=True)
+    generate(args.db_name, args.picture_directory, args.items, args.users, args.years, args.inventory_events, args.seed)
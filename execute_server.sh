@@ -5,7 +5,7 @@ if [[ -a /storage ]]; then
     if [[ ! -a /storage/pictures ]]; then
         mkdir /storage/pictures
     fi
-    python3 /app/server.py /storage/items.db /storage/pictures /app/certs/authorization.txt /app/certs/cert.pem /app/certs/key.pem
+    python3 /app/server.py /storage/items.db /storage/pictures /app/certs/authorization.txt /app/certs/cert.pem /app/certs/key.pem --production --backup-directory /storage/backups
 else
-    python3 /app/server.py /app/items.db /app/pictures /app/certs/authorization.txt /app/certs/cert.pem /app/certs/key.pem
+    python3 /app/server.py /app/items.db /app/pictures /app/certs/authorization.txt /app/certs/cert.pem /app/certs/key.pem --production
 fi
@@ -0,0 +1,104 @@
+import argparse
+import sys
+
+import server
+
+def migrate(args):
+    server.migrate_db(args.db_name)
+
+def gc_pictures(args):
+    print(f'Removed {server.collect_picture_garbage(args.db_name, args.picture_directory)} unreferenced picture files')
+
+def migrate_pictures(args):
+    print(f'Moved {server.migrate_pictures(args.db_name, args.picture_directory)} pictures to content-addressed storage')
+
+def rebuild_presence(args):
+    server.rebuild_user_presence(args.db_name)
+
+def rebuild_open_checkouts(args):
+    server.rebuild_open_toolshed_checkouts(args.db_name)
+
+def rebuild_search(args):
+    server.rebuild_search_index(args.db_name)
+
+def catalog_format(args, path):
+    if args.format is not None:
+        return args.format
+    return 'csv' if path is not None and path.endswith('.csv') else 'ndjson'
+
+def import_catalog(args):
+    server.migrate_db(args.db_name)
+    con = server.connect_db(args.db_name)
+    try:
+        job_id = server.create_import_job(con, args.kind)
+    finally:
+        con.close()
+    progress = server.run_import_job(args.db_name, job_id, args.kind, args.path, catalog_format(args, args.path))
+    for error in progress['errors']:
+        print(f'Row {error["index"]}: {error["error"]}', file=sys.stderr)
+    print(f'Imported {progress["rows_imported"]} of {progress["rows_read"]} rows into {args.kind} ({progress["error_count"]} errors)')
+
+def export_catalog(args):
+    if args.output is None:
+        server.write_catalog_export(args.db_name, args.kind, catalog_format(args, None), sys.stdout.buffer)
+    else:
+        with open(args.output, 'wb') as output:
+            server.write_catalog_export(args.db_name, args.kind, catalog_format(args, args.output), output)
+
+def backup(args):
+    try:
+        status = server.create_backup(args.db_name, args.picture_directory, args.backup_directory, args.retention)
+    except server.BackupInProgress:
+        sys.exit(f'Another backup into {args.backup_directory} is running')
+    print(f'Wrote backup {status["name"]} ({status["pictures_linked"]} pictures linked, {status["pictures_copied"]} copied)')
+
+def compact_change_log(args):
+    server.compact_change_log(args.db_name, args.retention_days * 24 * 60 * 60)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintenance commands for the inventory server database.')
+    subparsers = parser.add_subparsers(required=True)
+    migrate_parser = subparsers.add_parser('migrate', help='Apply pending schema migrations.')
+    migrate_parser.add_argument('db_name')
+    migrate_parser.set_defaults(func=migrate)
+    compact_parser = subparsers.add_parser('compact-change-log', help='Drop sync deletion records older than the retention period.')
+    compact_parser.add_argument('db_name')
+    compact_parser.add_argument('--retention-days', type=int, default=server.change_log_retention_seconds // (24 * 60 * 60))
+    compact_parser.set_defaults(func=compact_change_log)
+    gc_pictures_parser = subparsers.add_parser('gc-pictures', help='Delete stored pictures and variants no item or user refers to.')
+    gc_pictures_parser.add_argument('db_name')
+    gc_pictures_parser.add_argument('picture_directory')
+    gc_pictures_parser.set_defaults(func=gc_pictures)
+    migrate_pictures_parser = subparsers.add_parser('migrate-pictures', help='Move uuid-named pictures into content-addressed storage.')
+    migrate_pictures_parser.add_argument('db_name')
+    migrate_pictures_parser.add_argument('picture_directory')
+    migrate_pictures_parser.set_defaults(func=migrate_pictures)
+    rebuild_presence_parser = subparsers.add_parser('rebuild-presence', help='Recompute who is checked in from the full check-in/check-out history.')
+    rebuild_presence_parser.add_argument('db_name')
+    rebuild_presence_parser.set_defaults(func=rebuild_presence)
+    rebuild_open_checkouts_parser = subparsers.add_parser('rebuild-open-checkouts', help='Recompute outstanding toolshed checkouts from the checkout/checkin ledger.')
+    rebuild_open_checkouts_parser.add_argument('db_name')
+    rebuild_open_checkouts_parser.set_defaults(func=rebuild_open_checkouts)
+    rebuild_search_parser = subparsers.add_parser('rebuild-search', help='Rebuild the item and user search index, creating it if SQLite now supports FTS5.')
+    rebuild_search_parser.add_argument('db_name')
+    rebuild_search_parser.set_defaults(func=rebuild_search)
+    import_parser = subparsers.add_parser('import', help='Load items, users or container/vehicle/location memberships from a CSV or NDJSON file.')
+    import_parser.add_argument('db_name')
+    import_parser.add_argument('kind', choices=list(server.catalog_tables))
+    import_parser.add_argument('path')
+    import_parser.add_argument('--format', choices=list(server.catalog_formats), help='Defaults to csv for .csv files and ndjson otherwise.')
+    import_parser.set_defaults(func=import_catalog)
+    export_parser = subparsers.add_parser('export', help='Write items, users or memberships as CSV or NDJSON.')
+    export_parser.add_argument('db_name')
+    export_parser.add_argument('kind', choices=list(server.catalog_tables))
+    export_parser.add_argument('--output', help='File to write instead of standard output.')
+    export_parser.add_argument('--format', choices=list(server.catalog_formats), help='Defaults to csv for .csv output files and ndjson otherwise.')
+    export_parser.set_defaults(func=export_catalog)
+    backup_parser = subparsers.add_parser('backup', help='Take an online backup of the database and a snapshot of the pictures.')
+    backup_parser.add_argument('db_name')
+    backup_parser.add_argument('picture_directory')
+    backup_parser.add_argument('backup_directory')
+    backup_parser.add_argument('--retention', type=int, default=server.backup_retention_count, help='Number of backups to keep.')
+    backup_parser.set_defaults(func=backup)
+    args = parser.parse_args()
+    args.func(args)
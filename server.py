@@ -1,18 +1,53 @@
-from dataclasses import asdict, dataclass
+from dataclasses import asdict, dataclass, fields
 from enum import Enum
-from flask import Flask, jsonify, request, send_from_directory, abort
+from flask import Flask, Response, g, jsonify, make_response, request, send_from_directory, abort
 from functools import wraps
 from typing import Optional
+import argparse
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import csv
+import errno
+import fcntl
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import logging
+import logging.handlers
+import operator
 import os.path
+import queue
+import random
+import re
+import shutil
+import signal
+import threading
 import time
 import sqlite3
 import sys
+import tempfile
 import uuid
 
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 app = Flask(__name__)
 db_name = None
 picture_directory = None
 auth_value = None
+backup_directory = None
+logger = logging.getLogger('inventory_server')
+request_logger = logging.getLogger('inventory_server.requests')
 
 @dataclass
 class Item:
@@ -98,16 +133,917 @@ def convert_user(s):
 sqlite3.register_adapter(User, adapt_user)
 sqlite3.register_converter("user", convert_user)
 
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+max_statement_label_length = 200
+slow_query_seconds = float(os.environ['INVENTORY_SLOW_QUERY_MS']) / 1000 if 'INVENTORY_SLOW_QUERY_MS' in os.environ else None
+
+class ThreadMetrics:
+    def __init__(self):
+        self.requests = {}
+        self.request_latencies = {}
+        self.request_latency_sums = {}
+        self.rows = {}
+        self.statements = {}
+        self.pending_rows = 0
+
+    def record_request(self, endpoint, method, status, duration):
+        key = (endpoint, method, status)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        latencies = self.request_latencies.get(endpoint)
+        if latencies is None:
+            latencies = self.request_latencies[endpoint] = [0] * (len(latency_buckets) + 1)
+        latencies[bisect.bisect_left(latency_buckets, duration)] += 1
+        self.request_latency_sums[endpoint] = self.request_latency_sums.get(endpoint, 0.0) + duration
+        self.rows[endpoint] = self.rows.get(endpoint, 0) + self.pending_rows
+        self.pending_rows = 0
+
+    def record_statement(self, sql, duration):
+        statement = self.statements.get(sql)
+        if statement is None:
+            statement = self.statements[sql] = [0, 0.0]
+        statement[0] += 1
+        statement[1] += duration
+
+    def to_json(self):
+        # Pairs rather than objects, since keys are tuples or may be None.
+        return {
+            'requests': [[list(key), count] for key, count in dict(self.requests).items()],
+            'request_latencies': list(dict(self.request_latencies).items()),
+            'request_latency_sums': list(dict(self.request_latency_sums).items()),
+            'rows': list(dict(self.rows).items()),
+            'statements': list(dict(self.statements).items()),
+        }
+
+    @classmethod
+    def from_json(cls, value):
+        metrics = cls()
+        metrics.requests = {tuple(key): count for key, count in value['requests']}
+        metrics.request_latencies = dict(value['request_latencies'])
+        metrics.request_latency_sums = dict(value['request_latency_sums'])
+        metrics.rows = dict(value['rows'])
+        metrics.statements = dict(value['statements'])
+        return metrics
+
+    def merge(self, other):
+        for key, count in dict(other.requests).items():
+            self.requests[key] = self.requests.get(key, 0) + count
+        for endpoint, latencies in dict(other.request_latencies).items():
+            merged = self.request_latencies.setdefault(endpoint, [0] * (len(latency_buckets) + 1))
+            for i, count in enumerate(latencies):
+                merged[i] += count
+        for endpoint, duration in dict(other.request_latency_sums).items():
+            self.request_latency_sums[endpoint] = self.request_latency_sums.get(endpoint, 0.0) + duration
+        for endpoint, count in dict(other.rows).items():
+            self.rows[endpoint] = self.rows.get(endpoint, 0) + count
+        for sql, (count, duration) in dict(other.statements).items():
+            merged = self.statements.setdefault(sql, [0, 0.0])
+            merged[0] += count
+            merged[1] += duration
+
+metrics_local = threading.local()
+metrics_lock = threading.Lock()
+live_thread_metrics = []
+retired_thread_metrics = ThreadMetrics()
+
+def get_thread_metrics():
+    try:
+        return metrics_local.metrics
+    except AttributeError:
+        pass
+    metrics = ThreadMetrics()
+    with metrics_lock:
+        for thread, other in list(live_thread_metrics):
+            if not thread.is_alive():
+                retired_thread_metrics.merge(other)
+                live_thread_metrics.remove((thread, other))
+        live_thread_metrics.append((threading.current_thread(), metrics))
+    metrics_local.metrics = metrics
+    return metrics
+
+def collect_metrics():
+    metrics = ThreadMetrics()
+    with metrics_lock:
+        metrics.merge(retired_thread_metrics)
+        for thread, other in live_thread_metrics:
+            metrics.merge(other)
+    return metrics
+
+# Set in the gunicorn master before forking. Each worker then writes its counters
+# there, and a scrape, which only reaches one worker, merges all of them.
+metrics_directory = None
+metrics_flush_interval_seconds = 5
+metrics_file_lock = threading.Lock()
+
+def write_worker_metrics():
+    path = os.path.join(metrics_directory, f'{os.getpid()}.json')
+    snapshot = {'pid': os.getpid(), 'metrics': collect_metrics().to_json(), 'caches': collect_cache_metrics(lookup_caches)}
+    with metrics_file_lock:
+        with open(path + '.tmp', 'w') as metrics_file:
+            json.dump(snapshot, metrics_file)
+        os.replace(path + '.tmp', path)
+
+def flush_worker_metrics():
+    try:
+        write_worker_metrics()
+    except FileNotFoundError:
+        # The master removes the directory when it shuts down.
+        pass
+    except OSError:
+        logger.exception('Could not write worker metrics')
+
+def run_worker_metrics_writer():
+    while True:
+        time.sleep(metrics_flush_interval_seconds)
+        flush_worker_metrics()
+
+def start_worker_metrics_writer():
+    if metrics_directory is None:
+        return
+    threading.Thread(target=run_worker_metrics_writer, name='metrics-writer', daemon=True).start()
+    atexit.register(flush_worker_metrics)
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def collect_worker_metrics():
+    # Files of exited workers are kept, so the merged counters never go down;
+    # only the cache size gauge is limited to live workers.
+    write_worker_metrics()
+    metrics = ThreadMetrics()
+    cache_counts = {}
+    for filename in sorted(os.listdir(metrics_directory)):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(metrics_directory, filename)) as metrics_file:
+                snapshot = json.load(metrics_file)
+        except (FileNotFoundError, ValueError):
+            continue
+        metrics.merge(ThreadMetrics.from_json(snapshot['metrics']))
+        alive = process_alive(snapshot['pid'])
+        for name, (hits, misses, entries) in snapshot['caches'].items():
+            merged = cache_counts.setdefault(name, [0, 0, 0])
+            merged[0] += hits
+            merged[1] += misses
+            if alive:
+                merged[2] += entries
+    return metrics, cache_counts
+
+def record_statement(cur, sql, parameters, duration):
+    get_thread_metrics().record_statement(sql, duration)
+    if slow_query_seconds is not None and duration >= slow_query_seconds:
+        try:
+            plan = [row[-1] for row in sqlite3.Cursor(cur.connection).execute('EXPLAIN QUERY PLAN ' + sql, parameters)]
+        except sqlite3.Error:
+            plan = []
+        logger.warning('Slow query took %.2f ms: %s; plan: %s', duration * 1000, ' '.join(sql.split()), ' | '.join(plan))
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_statement(self, sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_statement(self, sql, (), time.perf_counter() - start)
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            get_thread_metrics().pending_rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        get_thread_metrics().pending_rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        get_thread_metrics().pending_rows += len(rows)
+        return rows
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def escape_metric_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_metrics(metrics):
+    lines = [
+        '# HELP inventory_http_requests_total Requests handled, by endpoint, method and status.',
+        '# TYPE inventory_http_requests_total counter',
+    ]
+    for (endpoint, method, status), count in sorted(metrics.requests.items(), key=str):
+        lines.append(f'inventory_http_requests_total{{endpoint="{escape_metric_label(endpoint)}",method="{method}",status="{status}"}} {count}')
+    lines += [
+        '# HELP inventory_http_request_duration_seconds Request latency, by endpoint.',
+        '# TYPE inventory_http_request_duration_seconds histogram',
+    ]
+    for endpoint, latencies in sorted(metrics.request_latencies.items(), key=str):
+        label = escape_metric_label(endpoint)
+        cumulative_count = 0
+        for bucket, count in zip(latency_buckets + ('+Inf',), latencies):
+            cumulative_count += count
+            lines.append(f'inventory_http_request_duration_seconds_bucket{{endpoint="{label}",le="{bucket}"}} {cumulative_count}')
+        lines.append(f'inventory_http_request_duration_seconds_sum{{endpoint="{label}"}} {metrics.request_latency_sums[endpoint]}')
+        lines.append(f'inventory_http_request_duration_seconds_count{{endpoint="{label}"}} {cumulative_count}')
+    lines += [
+        '# HELP inventory_http_response_rows_total Database rows read while handling requests, by endpoint.',
+        '# TYPE inventory_http_response_rows_total counter',
+    ]
+    for endpoint, count in sorted(metrics.rows.items(), key=str):
+        lines.append(f'inventory_http_response_rows_total{{endpoint="{escape_metric_label(endpoint)}"}} {count}')
+    lines += [
+        '# HELP inventory_sql_statement_duration_seconds Time spent executing each SQL statement.',
+        '# TYPE inventory_sql_statement_duration_seconds summary',
+    ]
+    for sql, (count, duration) in sorted(metrics.statements.items()):
+        label = escape_metric_label(' '.join(sql.split())[:max_statement_label_length])
+        lines.append(f'inventory_sql_statement_duration_seconds_sum{{statement="{label}"}} {duration}')
+        lines.append(f'inventory_sql_statement_duration_seconds_count{{statement="{label}"}} {count}')
+    return '\n'.join(lines) + '\n'
+
+class ConnectionPool:
+    def __init__(self, database, max_idle_connections):
+        self.database = database
+        self.idle_connections = queue.LifoQueue(maxsize=max_idle_connections)
+
+    def acquire(self):
+        try:
+            return self.idle_connections.get_nowait()
+        except queue.Empty:
+            return connect_db(self.database)
+
+    def release(self, con):
+        if con.in_transaction:
+            con.rollback()
+        con.row_factory = None
+        try:
+            self.idle_connections.put_nowait(con)
+        except queue.Full:
+            con.close()
+
+    def close(self):
+        while True:
+            try:
+                self.idle_connections.get_nowait().close()
+            except queue.Empty:
+                return
+
+max_idle_connections = 16
+busy_timeout_seconds = 5.0
+connection_pool = None
+connection_pool_lock = threading.Lock()
+
+def connect_db(database):
+    con = sqlite3.connect(database, timeout=busy_timeout_seconds, check_same_thread=False, factory=InstrumentedConnection)
+    con.execute('PRAGMA journal_mode = WAL')
+    con.execute('PRAGMA synchronous = NORMAL')
+    con.execute('PRAGMA cache_size = -16384')
+    con.execute('PRAGMA mmap_size = 268435456')
+    con.execute('PRAGMA temp_store = MEMORY')
+    return con
+
+def get_connection_pool():
+    global connection_pool
+    with connection_pool_lock:
+        if connection_pool is None or connection_pool.database != db_name:
+            if connection_pool is not None:
+                connection_pool.close()
+            connection_pool = ConnectionPool(db_name, max_idle_connections)
+        return connection_pool
+
+def get_db():
+    if 'db' not in g:
+        g.db = get_connection_pool().acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exception):
+    con = g.pop('db', None)
+    if con is not None:
+        get_connection_pool().release(con)
+
+class GroupCommitWriter:
+    def __init__(self, database, max_queued_writes, max_batch_size, flush_interval_seconds):
+        self.database = database
+        self.writes = queue.Queue(maxsize=max_queued_writes)
+        self.max_batch_size = max_batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.thread = threading.Thread(target=self.run, name='group-commit-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, operation):
+        future = concurrent.futures.Future()
+        self.writes.put((operation, future), timeout=busy_timeout_seconds)
+        return future
+
+    def close(self):
+        if self.thread.is_alive():
+            self.writes.put(None)
+            self.thread.join()
+
+    def next_batch(self):
+        write = self.writes.get()
+        if write is None:
+            return None
+        batch = [write]
+        deadline = time.monotonic() + self.flush_interval_seconds
+        while len(batch) < self.max_batch_size:
+            try:
+                write = self.writes.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if write is None:
+                self.writes.put(None)
+                break
+            batch.append(write)
+        return batch
+
+    def run(self):
+        con = connect_db(self.database)
+        con.isolation_level = None
+        if group_commit_durability == 'durable':
+            con.execute('PRAGMA synchronous = FULL')
+        cur = con.cursor()
+        try:
+            while True:
+                batch = self.next_batch()
+                if batch is None:
+                    return
+                self.flush(cur, batch)
+        finally:
+            con.close()
+
+    def flush(self, cur, batch):
+        # Each operation runs in its own savepoint so one failing write does not
+        # discard the rest of the batch, and the whole batch shares one commit.
+        errors = {}
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            for index, (operation, future) in enumerate(batch):
+                cur.execute('SAVEPOINT operation')
+                try:
+                    operation(cur)
+                except Exception as e:
+                    cur.execute('ROLLBACK TO operation')
+                    errors[index] = e
+                cur.execute('RELEASE operation')
+            cur.execute('COMMIT')
+        except Exception as e:
+            if cur.connection.in_transaction:
+                cur.execute('ROLLBACK')
+            errors = dict.fromkeys(range(len(batch)), e)
+        for index, (operation, future) in enumerate(batch):
+            if index in errors:
+                future.set_exception(errors[index])
+                if group_commit_durability == 'queued':
+                    logger.error('Queued write failed', exc_info=errors[index])
+            else:
+                future.set_result(None)
+
+group_commit_durability = os.environ.get('INVENTORY_GROUP_COMMIT', 'off')
+assert group_commit_durability in ('off', 'queued', 'commit', 'durable')
+max_queued_writes = int(os.environ.get('INVENTORY_GROUP_COMMIT_QUEUE_SIZE', '4096'))
+max_group_commit_batch_size = int(os.environ.get('INVENTORY_GROUP_COMMIT_BATCH_SIZE', '256'))
+group_commit_interval_seconds = float(os.environ.get('INVENTORY_GROUP_COMMIT_INTERVAL_MS', '5')) / 1000
+group_commit_writer = None
+group_commit_writer_lock = threading.Lock()
+
+def get_group_commit_writer():
+    global group_commit_writer
+    with group_commit_writer_lock:
+        if group_commit_writer is None or group_commit_writer.database != db_name:
+            if group_commit_writer is not None:
+                group_commit_writer.close()
+            group_commit_writer = GroupCommitWriter(db_name, max_queued_writes, max_group_commit_batch_size, group_commit_interval_seconds)
+            atexit.register(group_commit_writer.close)
+        return group_commit_writer
+
+def submit_write(operation):
+    if group_commit_durability == 'off':
+        con = get_db()
+        operation(con.cursor())
+        con.commit()
+        return
+    try:
+        future = get_group_commit_writer().submit(operation)
+    except queue.Full:
+        abort(503)
+    if group_commit_durability != 'queued':
+        future.result()
+
+class LookupCache:
+    def __init__(self, name, max_entries, ttl_seconds):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = collections.OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load, sequence=None):
+        # With a change sequence, only an entry loaded at or after that sequence
+        # is used, which catches writes handled by other worker processes.
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic() and (sequence is None or (entry[2] is not None and entry[2] >= sequence)):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+        value = load()
+        with self.lock:
+            # An invalidation while the value was loading may mean it is already stale.
+            if generation == self.generation and self.ttl_seconds > 0:
+                self.entries[key] = (time.monotonic() + self.ttl_seconds, value, sequence)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+max_lookup_cache_entries = int(os.environ.get('INVENTORY_LOOKUP_CACHE_SIZE', '10000'))
+lookup_cache_ttl_seconds = float(os.environ.get('INVENTORY_LOOKUP_CACHE_TTL_SECONDS', '30'))
+item_cache = LookupCache('items', max_lookup_cache_entries, lookup_cache_ttl_seconds)
+user_cache = LookupCache('users', max_lookup_cache_entries, lookup_cache_ttl_seconds)
+registered_device_cache = LookupCache('registered_devices', max_lookup_cache_entries, lookup_cache_ttl_seconds)
+lookup_caches = [item_cache, user_cache, registered_device_cache]
+
+def collect_cache_metrics(caches):
+    return {cache.name: [cache.hits, cache.misses, len(cache.entries)] for cache in caches}
+
+def format_cache_metrics(cache_counts):
+    lines = [
+        '# HELP inventory_lookup_cache_hits_total Lookups answered from the in-process cache.',
+        '# TYPE inventory_lookup_cache_hits_total counter',
+    ]
+    lines += [f'inventory_lookup_cache_hits_total{{cache="{name}"}} {hits}' for name, (hits, misses, entries) in cache_counts.items()]
+    lines += [
+        '# HELP inventory_lookup_cache_misses_total Lookups that had to query the database.',
+        '# TYPE inventory_lookup_cache_misses_total counter',
+    ]
+    lines += [f'inventory_lookup_cache_misses_total{{cache="{name}"}} {misses}' for name, (hits, misses, entries) in cache_counts.items()]
+    lines += [
+        '# HELP inventory_lookup_cache_entries Entries currently held in the cache.',
+        '# TYPE inventory_lookup_cache_entries gauge',
+    ]
+    lines += [f'inventory_lookup_cache_entries{{cache="{name}"}} {entries}' for name, (hits, misses, entries) in cache_counts.items()]
+    return '\n'.join(lines) + '\n'
+
+def load_item(barcode_id):
+    con = get_db()
+    cur = con.cursor()
+    cur.row_factory = row_to_item_factory
+    return cur.execute('SELECT * FROM items WHERE barcode_id = ?', (barcode_id,)).fetchone()
+
+def load_user(barcode_id):
+    con = get_db()
+    cur = con.cursor()
+    cur.row_factory = lambda cursor, row: User(*row)
+    return cur.execute('SELECT * FROM users WHERE barcode_id = ?', (barcode_id,)).fetchone()
+
+def load_registered_device(android_id):
+    con = get_db()
+    cur = con.cursor()
+    res = cur.execute('SELECT barcode_id FROM registered_devices WHERE android_id = ?', (android_id,)).fetchone()
+    return None if res is None else res[0]
+
+rebuild_user_presence_statements = [
+    'DELETE FROM user_presence',
+    """INSERT INTO user_presence (user_id, state, last_unix_time)
+    SELECT user_id, type, unix_time FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY unix_time DESC) AS row_num FROM (SELECT 'checkin' AS type, * FROM user_checkins UNION SELECT 'checkout' AS type, * FROM user_checkouts))
+    WHERE row_num = 1""",
+]
+
+search_index_statements = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS items_search USING fts5(barcode_id, short_id, name, description, content='items', content_rowid='rowid', prefix='2 3')",
+    # INSERT OR REPLACE removes the old row without firing delete triggers, so
+    # its index entry is dropped before the insert instead.
+    """CREATE TRIGGER IF NOT EXISTS items_search_before_insert BEFORE INSERT ON items BEGIN
+        INSERT INTO items_search (items_search, rowid, barcode_id, short_id, name, description)
+            SELECT 'delete', rowid, barcode_id, short_id, name, description FROM items WHERE barcode_id = new.barcode_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_search_after_insert AFTER INSERT ON items BEGIN
+        INSERT INTO items_search (rowid, barcode_id, short_id, name, description) VALUES (new.rowid, new.barcode_id, new.short_id, new.name, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_search_after_update AFTER UPDATE OF barcode_id, short_id, name, description ON items BEGIN
+        INSERT INTO items_search (items_search, rowid, barcode_id, short_id, name, description) VALUES ('delete', old.rowid, old.barcode_id, old.short_id, old.name, old.description);
+        INSERT INTO items_search (rowid, barcode_id, short_id, name, description) VALUES (new.rowid, new.barcode_id, new.short_id, new.name, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_search_after_delete AFTER DELETE ON items BEGIN
+        INSERT INTO items_search (items_search, rowid, barcode_id, short_id, name, description) VALUES ('delete', old.rowid, old.barcode_id, old.short_id, old.name, old.description);
+    END""",
+    "INSERT INTO items_search (items_search) VALUES ('rebuild')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_search USING fts5(barcode_id, name, company, content='users', content_rowid='rowid', prefix='2 3')",
+    """CREATE TRIGGER IF NOT EXISTS users_search_before_insert BEFORE INSERT ON users BEGIN
+        INSERT INTO users_search (users_search, rowid, barcode_id, name, company)
+            SELECT 'delete', rowid, barcode_id, name, company FROM users WHERE barcode_id = new.barcode_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_search_after_insert AFTER INSERT ON users BEGIN
+        INSERT INTO users_search (rowid, barcode_id, name, company) VALUES (new.rowid, new.barcode_id, new.name, new.company);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_search_after_update AFTER UPDATE OF barcode_id, name, company ON users BEGIN
+        INSERT INTO users_search (users_search, rowid, barcode_id, name, company) VALUES ('delete', old.rowid, old.barcode_id, old.name, old.company);
+        INSERT INTO users_search (rowid, barcode_id, name, company) VALUES (new.rowid, new.barcode_id, new.name, new.company);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_search_after_delete AFTER DELETE ON users BEGIN
+        INSERT INTO users_search (users_search, rowid, barcode_id, name, company) VALUES ('delete', old.rowid, old.barcode_id, old.name, old.company);
+    END""",
+    "INSERT INTO users_search (users_search) VALUES ('rebuild')",
+]
+
+def create_search_index(con):
+    if not con.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").fetchone()[0]:
+        logger.warning('SQLite was built without FTS5; search falls back to scanning items and users')
+        return
+    for statement in search_index_statements:
+        con.execute(statement)
+
+rebuild_open_toolshed_checkouts_statements = [
+    'DELETE FROM open_toolshed_checkouts',
+    'INSERT INTO open_toolshed_checkouts (checkout_id, item_id, user_id) SELECT checkout_id, item_id, user_id FROM toolshed_checkouts \
+            WHERE checkout_id NOT IN (SELECT checkout_id FROM toolshed_checkins WHERE checkout_id IS NOT NULL)',
+]
+
+migrations = [
+    [
+        'DELETE FROM containers WHERE rowid NOT IN (SELECT max(rowid) FROM containers GROUP BY item_id)',
+        'DELETE FROM vehicles WHERE rowid NOT IN (SELECT max(rowid) FROM vehicles GROUP BY item_id)',
+        'DELETE FROM locations WHERE rowid NOT IN (SELECT max(rowid) FROM locations GROUP BY item_id)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS containers_item_id ON containers (item_id)',
+        'CREATE INDEX IF NOT EXISTS containers_container_id ON containers (container_id)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS vehicles_item_id ON vehicles (item_id)',
+        'CREATE INDEX IF NOT EXISTS vehicles_container_id ON vehicles (container_id)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS locations_item_id ON locations (item_id)',
+        'CREATE INDEX IF NOT EXISTS locations_container_id ON locations (container_id)',
+        'CREATE INDEX IF NOT EXISTS inventoried_items_item_id ON inventoried_items (item_id)',
+        'CREATE INDEX IF NOT EXISTS toolshed_checkouts_item_id_unix_time ON toolshed_checkouts (item_id, unix_time)',
+        'CREATE INDEX IF NOT EXISTS toolshed_checkouts_user_id ON toolshed_checkouts (user_id)',
+        'CREATE INDEX IF NOT EXISTS toolshed_checkins_checkout_id ON toolshed_checkins (checkout_id)',
+        'CREATE INDEX IF NOT EXISTS user_checkins_user_id_unix_time ON user_checkins (user_id, unix_time)',
+        'CREATE INDEX IF NOT EXISTS user_checkouts_user_id_unix_time ON user_checkouts (user_id, unix_time)',
+        'ANALYZE',
+    ],
+    [
+        'CREATE TABLE change_sequence (id INTEGER PRIMARY KEY CHECK (id = 0), seq INTEGER NOT NULL, unix_time INTEGER NOT NULL)',
+        "INSERT INTO change_sequence (id, seq, unix_time) VALUES (0, 0, CAST(strftime('%s', 'now') AS INTEGER))",
+    ],
+    [
+        'CREATE TABLE change_log (table_name TEXT NOT NULL, row_key TEXT NOT NULL, seq INTEGER NOT NULL, deleted INTEGER NOT NULL, unix_time INTEGER NOT NULL, PRIMARY KEY (table_name, row_key))',
+        'CREATE INDEX change_log_seq ON change_log (seq)',
+        'ALTER TABLE change_sequence ADD COLUMN compacted_through INTEGER NOT NULL DEFAULT 0',
+        'UPDATE change_sequence SET seq = seq + 1, compacted_through = seq + 1',
+    ],
+    [
+        'CREATE TABLE user_presence (user_id STRING PRIMARY KEY, state STRING NOT NULL, last_unix_time INTEGER NOT NULL)',
+        'CREATE INDEX user_presence_state ON user_presence (state)',
+    ] + rebuild_user_presence_statements,
+    [
+        'CREATE TABLE open_toolshed_checkouts (checkout_id INTEGER PRIMARY KEY, item_id STRING, user_id STRING)',
+        'CREATE INDEX open_toolshed_checkouts_item_id ON open_toolshed_checkouts (item_id)',
+        'CREATE INDEX open_toolshed_checkouts_user_id ON open_toolshed_checkouts (user_id)',
+    ] + rebuild_open_toolshed_checkouts_statements,
+    [
+        'CREATE TABLE inventory_event_summaries (inventory_id INTEGER PRIMARY KEY, summary TEXT NOT NULL)',
+    ],
+    create_search_index,
+    [
+        'CREATE TABLE import_jobs (id TEXT PRIMARY KEY, kind TEXT NOT NULL, state TEXT NOT NULL, rows_read INTEGER NOT NULL DEFAULT 0, \
+                rows_imported INTEGER NOT NULL DEFAULT 0, error_count INTEGER NOT NULL DEFAULT 0, errors TEXT NOT NULL DEFAULT \'[]\', \
+                message TEXT, created_unix_time INTEGER NOT NULL, finished_unix_time INTEGER)',
+    ],
+    [
+        'CREATE TABLE table_change_sequences (name TEXT PRIMARY KEY, seq INTEGER NOT NULL, unix_time INTEGER NOT NULL)',
+        "INSERT INTO table_change_sequences (name, seq, unix_time) SELECT names.column1, seq, unix_time FROM change_sequence, \
+                (VALUES ('items'), ('containers'), ('vehicles'), ('locations')) AS names",
+    ],
+]
+
+def migrate_db(database):
+    con = sqlite3.connect(database, timeout=busy_timeout_seconds, isolation_level=None)
+    try:
+        con.execute('BEGIN IMMEDIATE')
+        schema_version = con.execute('PRAGMA user_version').fetchone()[0]
+        for version in range(schema_version, len(migrations)):
+            if callable(migrations[version]):
+                migrations[version](con)
+            else:
+                for statement in migrations[version]:
+                    con.execute(statement)
+            con.execute(f'PRAGMA user_version = {version + 1}')
+        con.execute('COMMIT')
+    except BaseException:
+        if con.in_transaction:
+            con.execute('ROLLBACK')
+        raise
+    finally:
+        con.close()
+
 def row_to_item_factory(cursor, row):
     return Item(*row)
 
-def do_check_auth_header(request):
-    print('Expected Auth: ' + auth_value)
-    print(str(request))
-    sys.stdout.flush()
-    if (request.headers.get('Authorization') == auth_value):
-        return
+def rebuild_user_presence(database):
+    con = connect_db(database)
+    try:
+        with con:
+            for statement in rebuild_user_presence_statements:
+                con.execute(statement)
+            user_ids = [[user_id] for (user_id,) in con.execute('SELECT user_id FROM user_presence').fetchall()]
+            if len(user_ids) > 0:
+                record_changes(con.cursor(), 'user_presence', user_ids)
+    finally:
+        con.close()
+
+def search_index_exists(cur):
+    return cur.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'items_search'").fetchone()[0] > 0
+
+def rebuild_search_index(database):
+    con = connect_db(database)
+    try:
+        with con:
+            if search_index_exists(con):
+                con.execute("INSERT INTO items_search (items_search) VALUES ('rebuild')")
+                con.execute("INSERT INTO users_search (users_search) VALUES ('rebuild')")
+            else:
+                create_search_index(con)
+    finally:
+        con.close()
+
+def rebuild_open_toolshed_checkouts(database):
+    con = connect_db(database)
+    try:
+        with con:
+            previous_checkout_ids = {checkout_id for (checkout_id,) in con.execute('SELECT checkout_id FROM open_toolshed_checkouts').fetchall()}
+            for statement in rebuild_open_toolshed_checkouts_statements:
+                con.execute(statement)
+            checkout_ids = {checkout_id for (checkout_id,) in con.execute('SELECT checkout_id FROM open_toolshed_checkouts').fetchall()}
+            if len(checkout_ids) > 0:
+                record_changes(con.cursor(), 'open_toolshed_checkouts', [[checkout_id] for checkout_id in sorted(checkout_ids)])
+            if len(previous_checkout_ids - checkout_ids) > 0:
+                record_changes(con.cursor(), 'open_toolshed_checkouts', [[checkout_id] for checkout_id in sorted(previous_checkout_ids - checkout_ids)], deleted=True)
+    finally:
+        con.close()
+
+def update_user_presence(cur, user_id, state, unix_time):
+    cur.execute('INSERT INTO user_presence (user_id, state, last_unix_time) VALUES (:user_id, :state, :unix_time) \
+            ON CONFLICT (user_id) DO UPDATE SET state = excluded.state, last_unix_time = excluded.last_unix_time WHERE excluded.last_unix_time >= user_presence.last_unix_time',
+            {'user_id': user_id, 'state': state, 'unix_time': unix_time})
+    if cur.rowcount > 0:
+        record_changes(cur, 'user_presence', [[user_id]])
+
+def bump_change_sequence(cur):
+    res = cur.execute('UPDATE change_sequence SET seq = seq + 1, unix_time = :unix_time WHERE id = 0 RETURNING seq', {'unix_time': int(time.time())})
+    return res.fetchone()[0]
+
+def get_change_sequence(cur):
+    return cur.execute('SELECT seq, unix_time FROM change_sequence WHERE id = 0').fetchone()
+
+def get_table_change_sequence(cur, names):
+    # The latest change sequence, and its time, of any of the named tables.
+    res = cur.execute(f'SELECT coalesce(max(seq), 0), coalesce(max(unix_time), 0) FROM table_change_sequences WHERE name IN ({", ".join("?" * len(names))})', names)
+    return res.fetchone()
+
+# Conditional item, container, vehicle and location reads only depend on these,
+# so check-ins, toolshed writes and inventory scans leave their ETags alone.
+catalog_sequence_tables = ['items', 'containers', 'vehicles', 'locations']
+
+# Tables whose rows also bump a sequence per value of one key column, for reads
+# that only cover part of the table (like one inventory event's summary).
+partitioned_sequence_tables = {'inventoried_items': 0}
+
+sync_tables = {
+    'items': ['barcode_id'],
+    'registered_devices': ['android_id'],
+    'users': ['barcode_id'],
+    'user_checkins': ['rowid'],
+    'user_checkouts': ['rowid'],
+    'user_presence': ['user_id'],
+    'containers': ['item_id'],
+    'vehicles': ['item_id'],
+    'locations': ['item_id'],
+    'inventory_events': ['id'],
+    'inventoried_items': ['inventory_id', 'item_id'],
+    'toolshed_checkouts': ['checkout_id'],
+    'toolshed_checkins': ['checkin_id'],
+    'open_toolshed_checkouts': ['checkout_id'],
+}
+change_log_retention_seconds = 30 * 24 * 60 * 60
+
+def record_changes(cur, table_name, row_keys, deleted=False):
+    assert table_name in sync_tables
+    seq = bump_change_sequence(cur)
+    unix_time = int(time.time())
+    cur.executemany('INSERT OR REPLACE INTO change_log (table_name, row_key, seq, deleted, unix_time) VALUES (?, ?, ?, ?, ?)',
+            [(table_name, json.dumps(row_key, separators=(',', ':')), seq, deleted, unix_time) for row_key in row_keys])
+    names = [table_name]
+    if table_name in partitioned_sequence_tables:
+        key_column = partitioned_sequence_tables[table_name]
+        names += sorted({f'{table_name}/{row_key[key_column]}' for row_key in row_keys})
+    cur.executemany('INSERT OR REPLACE INTO table_change_sequences (name, seq, unix_time) VALUES (?, ?, ?)', [(name, seq, unix_time) for name in names])
+    return seq
+
+def compact_change_log(database, retention_seconds=change_log_retention_seconds):
+    con = connect_db(database)
+    try:
+        with con:
+            cutoff = int(time.time()) - retention_seconds
+            res = con.execute('SELECT max(seq) FROM change_log WHERE deleted AND unix_time < :cutoff', {'cutoff': cutoff})
+            compacted_through = res.fetchone()[0]
+            if compacted_through is not None:
+                con.execute('DELETE FROM change_log WHERE deleted AND seq <= :compacted_through', {'compacted_through': compacted_through})
+                con.execute('UPDATE change_sequence SET compacted_through = max(compacted_through, :compacted_through) WHERE id = 0', {'compacted_through': compacted_through})
+    finally:
+        con.close()
+
+max_page_size = 10000
+stream_batch_size = 500
+
+compact_json_encoder = json.JSONEncoder(separators=(',', ':'))
+
+def rows_to_objects(column_names, rows, first_column=0):
+    # Keys are inserted in sorted order so the output matches jsonify's sort_keys
+    # without sorting every object again.
+    order = sorted(range(len(column_names)), key=column_names.__getitem__)
+    keys = [column_names[i] for i in order]
+    positions = [first_column + i for i in order]
+    if len(positions) == 1:
+        [key], [position] = keys, positions
+        return [{key: row[position]} for row in rows]
+    get_values = operator.itemgetter(*positions)
+    return [dict(zip(keys, get_values(row))) for row in rows]
+
+def dumps_rows(value, rows):
+    # orjson matches the standard encoder except for non-ASCII text (which
+    # jsonify escapes, including DEL) and float formatting, so those fall back.
+    if orjson is not None and float not in set(map(type, itertools.chain.from_iterable(rows))):
+        body = orjson.dumps(value)
+        if body.isascii() and b'\x7f' not in body:
+            return body
+    return compact_json_encoder.encode(value).encode()
+
+def columns_response(column_names, rows, first_column=0):
+    objects = rows_to_objects(column_names, rows, first_column)
+    if app.debug:
+        return jsonify(objects)
+    return Response(dumps_rows(objects, rows) + b'\n', mimetype=app.json.mimetype)
+
+def rows_response(row_type, rows):
+    return columns_response([field.name for field in fields(row_type)], rows)
+
+def list_response(query, params, row_type, key_column):
+    column_names = [field.name for field in fields(row_type)]
+    selected_columns = column_names
+    if 'fields' in request.args:
+        selected_columns = request.args['fields'].split(',')
+        if not all(column in column_names for column in selected_columns):
+            abort(400)
+    after = request.args.get('after')
+    limit = request.args.get('limit', type=int)
+    stream = request.args.get('stream')
+    if stream not in (None, 'ndjson', 'json'):
+        abort(400)
+    query = f'SELECT {key_column}, {", ".join(selected_columns)} FROM ({query})'
+    if after is not None:
+        query += f' WHERE {key_column} > :after'
+        params = dict(params, after=after)
+    if after is not None or limit is not None:
+        query += f' ORDER BY {key_column}'
+    if limit is not None:
+        if limit <= 0:
+            abort(400)
+        query += ' LIMIT :limit'
+        params = dict(params, limit=min(limit, max_page_size))
+    if stream is not None:
+        # Flask tears down the app context before a streamed body is read,
+        # so the generator owns its connection instead of borrowing get_db().
+        pool = get_connection_pool()
+        con = pool.acquire()
+        try:
+            cur = con.cursor()
+            cur.arraysize = stream_batch_size
+            res = cur.execute(query, params)
+        except BaseException:
+            pool.release(con)
+            raise
+        if stream == 'ndjson':
+            return Response(generate_ndjson_rows(pool, con, res, selected_columns), mimetype='application/x-ndjson')
+        return Response(generate_json_rows(pool, con, res, selected_columns), mimetype='application/json')
+    con = get_db()
+    cur = con.cursor()
+    rows = cur.execute(query, params).fetchall()
+    response = columns_response(selected_columns, rows, first_column=1)
+    if limit is not None and len(rows) == min(limit, max_page_size):
+        response.headers['X-Next-Cursor'] = str(rows[-1][0])
+    return response
+
+def generate_ndjson_rows(pool, con, res, selected_columns):
+    try:
+        while rows := res.fetchmany():
+            objects = rows_to_objects(selected_columns, rows, first_column=1)
+            yield b''.join(dumps_rows(row_object, (row,)) + b'\n' for row_object, row in zip(objects, rows))
+    finally:
+        pool.release(con)
+
+def generate_json_rows(pool, con, res, selected_columns):
+    try:
+        separator = b'['
+        while rows := res.fetchmany():
+            yield separator + dumps_rows(rows_to_objects(selected_columns, rows, first_column=1), rows)[1:-1]
+            separator = b','
+        yield b'[]\n' if separator == b'[' else b']\n'
+    finally:
+        pool.release(con)
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, sample_rate):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record):
+        return record.levelno > logging.INFO or random.random() < self.sample_rate
+
+log_listener = None
+
+def configure_logging():
+    global log_listener
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    for sampling_filter in list(request_logger.filters):
+        request_logger.removeFilter(sampling_filter)
+    log_queue = queue.SimpleQueue()
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+    log_listener = logging.handlers.QueueListener(log_queue, console_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(os.environ.get('INVENTORY_LOG_LEVEL', 'INFO').upper())
+    logger.propagate = False
+    request_logger.addFilter(SamplingFilter(float(os.environ.get('INVENTORY_REQUEST_LOG_SAMPLE_RATE', '0.01'))))
+
+slow_request_seconds = float(os.environ.get('INVENTORY_SLOW_REQUEST_MS', '1000')) / 1000
+
+@app.before_request
+def start_request_timer():
+    g.request_start_time = time.perf_counter()
+    get_thread_metrics().pending_rows = 0
+
+@app.after_request
+def record_request_metrics(response):
+    duration = time.perf_counter() - g.get('request_start_time', time.perf_counter())
+    get_thread_metrics().record_request(request.endpoint, request.method, response.status_code, duration)
+    return response
+
+@app.after_request
+def log_request(response):
+    duration = time.perf_counter() - g.get('request_start_time', time.perf_counter())
+    if response.status_code >= 500:
+        level = logging.ERROR
+    elif duration >= slow_request_seconds:
+        level = logging.WARNING
     else:
+        level = logging.INFO
+    if request_logger.isEnabledFor(level):
+        request_logger.log(level, 'method=%s endpoint=%s path=%s status=%d duration_ms=%.2f',
+                request.method, request.endpoint, request.path, response.status_code, duration * 1000)
+    return response
+
+def do_check_auth_header(request):
+    authorization = request.headers.get('Authorization')
+    if authorization is None or not hmac.compare_digest(authorization.encode(), auth_value):
         abort(401)
 
 def check_auth_header(func):
@@ -117,322 +1053,694 @@ def check_auth_header(func):
         return func(*args, **kwargs)
     return decorated_func
 
+def conditional_on_changes(func):
+    @wraps(func)
+    def decorated_func(*args, **kwargs):
+        seq, unix_time = get_table_change_sequence(get_db().cursor(), catalog_sequence_tables)
+        g.catalog_sequence = seq
+        etag = str(seq)
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            # Last-Modified only has whole seconds, so a change in the same second
+            # as the client's copy must not count as unmodified.
+            not_modified = request.if_modified_since is not None and unix_time < request.if_modified_since.timestamp()
+        if not_modified:
+            response = Response(status=304)
+        else:
+            response = make_response(func(*args, **kwargs))
+        response.set_etag(etag)
+        response.last_modified = unix_time
+        return response
+    return decorated_func
+
+picture_variant_sizes = {'thumbnail': 160, 'medium': 800}
+picture_variant_cache_max_bytes = 512 * 1024 * 1024
+picture_variant_cache_check_interval_seconds = 60
+picture_variant_touch_interval_seconds = 24 * 60 * 60
+picture_variant_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='picture-variants')
+max_failed_picture_variants = 10000
+queued_picture_variants = set()
+failed_picture_variants = {}
+picture_variant_lock = threading.Lock()
+last_picture_variant_cache_check = 0
+
+picture_chunk_size = 64 * 1024
+picture_garbage_grace_seconds = 60 * 60
+
+def content_addressed_picture_path(digest):
+    return f'{digest[:2]}/{digest[2:4]}/{digest}'
+
+def hash_picture(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as picture:
+        while chunk := picture.read(picture_chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def store_picture(directory, temporary_path, digest):
+    picture_path = content_addressed_picture_path(digest)
+    full_picture_path = os.path.join(directory, picture_path)
+    if os.path.exists(full_picture_path):
+        os.utime(full_picture_path)
+        os.remove(temporary_path)
+    else:
+        os.makedirs(os.path.dirname(full_picture_path), exist_ok=True)
+        os.replace(temporary_path, full_picture_path)
+    return picture_path
+
+def link_picture(directory, path, digest):
+    picture_path = content_addressed_picture_path(digest)
+    full_picture_path = os.path.join(directory, picture_path)
+    if not os.path.exists(full_picture_path):
+        os.makedirs(os.path.dirname(full_picture_path), exist_ok=True)
+        temporary_path = f'{full_picture_path}.{uuid.uuid4()}.tmp'
+        try:
+            os.link(path, temporary_path)
+        except OSError:
+            shutil.copy2(path, temporary_path)
+        os.replace(temporary_path, full_picture_path)
+    return picture_path
+
+def save_picture(file):
+    digest = hashlib.sha256()
+    temporary_path = os.path.join(picture_directory, f'{uuid.uuid4()}.tmp')
+    try:
+        with open(temporary_path, 'wb') as output:
+            while chunk := file.stream.read(picture_chunk_size):
+                digest.update(chunk)
+                output.write(chunk)
+        return store_picture(picture_directory, temporary_path, digest.hexdigest())
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+def get_referenced_picture_paths(con):
+    res = con.execute('SELECT picture_path FROM items WHERE picture_path IS NOT NULL UNION SELECT picture_path FROM users WHERE picture_path IS NOT NULL')
+    return {str(picture_path) for (picture_path,) in res}
+
+def collect_picture_garbage(database, directory):
+    con = connect_db(database)
+    try:
+        referenced_picture_paths = get_referenced_picture_paths(con)
+    finally:
+        con.close()
+    cutoff = time.time() - picture_garbage_grace_seconds
+    removed = 0
+    for root, directories, filenames in os.walk(directory):
+        relative_root = os.path.relpath(root, directory).replace(os.sep, '/')
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            if relative_root == '.':
+                # Also catches uuid-named pictures left behind by an interrupted migrate-pictures.
+                orphaned = filename.endswith('.tmp') or filename not in referenced_picture_paths
+            elif relative_root == 'variants' or relative_root.startswith('variants/'):
+                orphaned = '/'.join(relative_root.split('/')[2:] + [filename.removesuffix('.jpg')]) not in referenced_picture_paths
+            else:
+                orphaned = f'{relative_root}/{filename}' not in referenced_picture_paths
+            if orphaned and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+    return removed
+
+def migrate_pictures(database, directory):
+    con = connect_db(database)
+    migrated = 0
+    try:
+        for picture_path in sorted(get_referenced_picture_paths(con)):
+            legacy_path = os.path.join(directory, picture_path)
+            if '/' in picture_path or not os.path.isfile(legacy_path):
+                continue
+            # The legacy file stays until no row refers to it, so a crash at any
+            # point leaves every row pointing at a picture that exists.
+            new_picture_path = link_picture(directory, legacy_path, hash_picture(legacy_path))
+            with con:
+                cur = con.cursor()
+                for table_name in ['items', 'users']:
+                    res = cur.execute(f'UPDATE {table_name} SET picture_path = :new_picture_path WHERE picture_path = :picture_path RETURNING barcode_id',
+                            {'new_picture_path': new_picture_path, 'picture_path': picture_path})
+                    barcode_ids = [[barcode_id] for (barcode_id,) in res.fetchall()]
+                    if len(barcode_ids) > 0:
+                        record_changes(cur, table_name, barcode_ids)
+            for size in picture_variant_sizes:
+                legacy_variant_path = os.path.join(directory, picture_variant_path(picture_path, size))
+                if os.path.exists(legacy_variant_path):
+                    os.makedirs(os.path.dirname(os.path.join(directory, picture_variant_path(new_picture_path, size))), exist_ok=True)
+                    os.replace(legacy_variant_path, os.path.join(directory, picture_variant_path(new_picture_path, size)))
+            os.remove(legacy_path)
+            migrated += 1
+    finally:
+        con.close()
+    return migrated
+
+def picture_variant_path(picture_path, size):
+    return os.path.join('variants', size, picture_path + '.jpg')
+
+def generate_picture_variant(picture_path, size):
+    variant_path = os.path.join(picture_directory, picture_variant_path(picture_path, size))
+    if os.path.exists(variant_path):
+        return
+    os.makedirs(os.path.dirname(variant_path), exist_ok=True)
+    temporary_path = f'{variant_path}.{uuid.uuid4()}.tmp'
+    try:
+        with Image.open(os.path.join(picture_directory, picture_path)) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((picture_variant_sizes[size], picture_variant_sizes[size]))
+            image.convert('RGB').save(temporary_path, 'JPEG', quality=85)
+        os.replace(temporary_path, variant_path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+def generate_picture_variants(picture_path):
+    try:
+        for size in picture_variant_sizes:
+            generate_picture_variant(picture_path, size)
+        limit_picture_variant_cache()
+    except Exception:
+        logger.exception('Could not generate variants of picture %s', picture_path)
+        with picture_variant_lock:
+            failed_picture_variants[picture_path] = True
+            if len(failed_picture_variants) > max_failed_picture_variants:
+                del failed_picture_variants[next(iter(failed_picture_variants))]
+    finally:
+        with picture_variant_lock:
+            queued_picture_variants.discard(picture_path)
+
+def queue_picture_variants(picture_path):
+    # Each picture is queued once at a time, and one that could not be decoded
+    # is not retried, so repeated requests for its variants cost nothing.
+    with picture_variant_lock:
+        if picture_path in queued_picture_variants or picture_path in failed_picture_variants:
+            return
+        queued_picture_variants.add(picture_path)
+    picture_variant_executor.submit(generate_picture_variants, picture_path)
+
+def limit_picture_variant_cache():
+    global last_picture_variant_cache_check
+    if time.time() - last_picture_variant_cache_check < picture_variant_cache_check_interval_seconds:
+        return
+    last_picture_variant_cache_check = time.time()
+    variants = []
+    for root, directories, filenames in os.walk(os.path.join(picture_directory, 'variants')):
+        for filename in filenames:
+            stat = os.stat(os.path.join(root, filename))
+            variants.append((stat.st_mtime, stat.st_size, os.path.join(root, filename)))
+    total_bytes = sum(size for mtime, size, path in variants)
+    for mtime, size, path in sorted(variants):
+        if total_bytes <= picture_variant_cache_max_bytes:
+            break
+        os.remove(path)
+        total_bytes -= size
+
+def send_picture_file(path):
+    # Picture URLs are keyed by barcode and change on re-upload, and need the
+    # Authorization header, so clients revalidate against the ETag every time.
+    response = send_from_directory(picture_directory, path)
+    response.cache_control.max_age = None
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def send_picture(picture_path):
+    size = request.args.get('size', 'original')
+    if size != 'original' and size not in picture_variant_sizes:
+        abort(400)
+    if size == 'original' or Image is None:
+        return send_picture_file(picture_path)
+    variant_path = picture_variant_path(picture_path, size)
+    full_variant_path = os.path.join(picture_directory, variant_path)
+    try:
+        if os.path.getmtime(full_variant_path) < time.time() - picture_variant_touch_interval_seconds:
+            os.utime(full_variant_path)
+    except FileNotFoundError:
+        # Pictures stored before variants existed are resized in the background;
+        # until then the original is served.
+        queue_picture_variants(picture_path)
+        return send_picture_file(picture_path)
+    return send_picture_file(variant_path)
+
 @app.route('/inventory/api/v1.0/registered-devices/<string:android_id>', methods=['GET'])
 @check_auth_header
 def get_registered_device_id(android_id):
-    con = sqlite3.connect(db_name)
-    cur = con.cursor()
-    res = cur.execute('SELECT barcode_id FROM registered_devices WHERE android_id = ?', (android_id,))
-    maybe_barcode_id = res.fetchone()
-    if maybe_barcode_id is not None and len(maybe_barcode_id) > 0:
-        return jsonify(maybe_barcode_id[0])
+    barcode_id = registered_device_cache.get(android_id, lambda: load_registered_device(android_id), get_table_change_sequence(get_db().cursor(), ['registered_devices'])[0])
+    if barcode_id is not None:
+        return jsonify(barcode_id)
     else:
         abort(404)
 
 @app.route('/inventory/api/v1.0/unregistered-devices/', methods=['GET'])
 @check_auth_header
 def get_unregistered_devices():
-    con = sqlite3.connect(db_name)
+    con = get_db()
     con.row_factory = lambda cursor, row: str(*row)
     cur = con.cursor()
     android_ids = cur.execute('SELECT android_id FROM registered_devices WHERE barcode_id IS NULL')
-    return jsonify(list(android_ids))
+    return jsonify(android_ids.fetchall())
 
 @app.route('/inventory/api/v1.0/unregistered-devices/<string:android_id>', methods=['PUT'])
 @check_auth_header
 def upload_device_id(android_id):
-    con = sqlite3.connect(db_name)
+    con = get_db()
     cur = con.cursor()
     cur.execute('INSERT OR REPLACE INTO registered_devices (android_id) VALUES (:android_id)', {'android_id': android_id})
+    record_changes(cur, 'registered_devices', [[android_id]])
     con.commit()
+    registered_device_cache.invalidate(android_id)
     return '', 200
 
 @app.route('/inventory/api/v1.0/registered-devices/<string:android_id>/<string:barcode_id>', methods=['POST'])
 @check_auth_header
 def register_device_id(android_id, barcode_id):
-    con = sqlite3.connect(db_name)
+    con = get_db()
     cur = con.cursor()
     cur.execute('UPDATE registered_devices SET barcode_id = :barcode_id WHERE android_id = :android_id', {'android_id': android_id, 'barcode_id': barcode_id})
+    if cur.rowcount > 0:
+        record_changes(cur, 'registered_devices', [[android_id]])
     con.commit()
+    registered_device_cache.invalidate(android_id)
     return '', 200
 
 @app.route('/inventory/api/v1.0/items', methods=['GET'])
 @check_auth_header
+@conditional_on_changes
 def get_items():
-    con = sqlite3.connect(db_name)
-    con.row_factory = row_to_item_factory
-    cur = con.cursor()
-    item_list = cur.execute('SELECT * FROM items;')
-    return jsonify(list(item_list))
+    return list_response('SELECT * FROM items', {}, Item, 'barcode_id')
 
 @app.route('/inventory/api/v1.0/items/<string:barcode_id>', methods=['GET'])
 @check_auth_header
+@conditional_on_changes
 def get_item(barcode_id):
-    print(barcode_id)
-    con = sqlite3.connect(db_name)
-    con.row_factory = row_to_item_factory
-    cur = con.cursor()
-    res = cur.execute('SELECT * FROM items WHERE barcode_id = ?', (barcode_id,))
-    item = res.fetchone()
-    print(item)
-    retval = jsonify(item)
-    print(retval)
-    return retval
+    item = item_cache.get(barcode_id, lambda: load_item(barcode_id), g.catalog_sequence)
+    return jsonify(item)
 
 @app.route('/inventory/api/v1.0/item-picture/<string:barcode_id>', methods=['GET'])
 @check_auth_header
 def get_item_pictures(barcode_id):
-    con = sqlite3.connect(db_name)
-    cur = con.cursor()
-    res = cur.execute('SELECT picture_path FROM items WHERE barcode_id = ?', (barcode_id,))
-    [picture_path] = res.fetchone()
-    return send_from_directory(picture_directory, picture_path)
+    item = item_cache.get(barcode_id, lambda: load_item(barcode_id), get_table_change_sequence(get_db().cursor(), ['items'])[0])
+    if item is None:
+        abort(404)
+    return send_picture(item.picture_path)
 
 @app.route('/inventory/api/v1.0/items/<string:barcode_id>', methods=['POST'])
 @check_auth_header
 def upload_item(barcode_id):
     assert request.method == 'POST'
-    unique_filename = str(uuid.uuid4())
-    file = request.files['picture']
-    file.save(os.path.join(picture_directory, unique_filename))
+    picture_path = save_picture(request.files['picture'])
     name = request.form['name']
-    con = sqlite3.connect(db_name)
+    con = get_db()
     cur = con.cursor()
-    cur.execute('INSERT OR REPLACE INTO items (barcode_id, name, picture_path) VALUES (:barcode_id, :name, :picture_path)', {'barcode_id': barcode_id, 'name': name, 'picture_path': unique_filename})
+    cur.execute('INSERT OR REPLACE INTO items (barcode_id, name, picture_path) VALUES (:barcode_id, :name, :picture_path)', {'barcode_id': barcode_id, 'name': name, 'picture_path': picture_path})
+    record_changes(cur, 'items', [[barcode_id]])
     con.commit()
+    item_cache.invalidate(barcode_id)
+    if Image is not None:
+        queue_picture_variants(picture_path)
     return '', 200
 
+max_container_depth = 64
+max_full_locations_batch_size = 5000
+
+full_locations_query = """
+WITH RECURSIVE container_path(requested_id, item_id, container_id, depth, visited) AS (
+    SELECT requested.value, item_id, container_id, 1, '/' || item_id || '/' || container_id || '/'
+    FROM json_each(:item_ids) AS requested INNER JOIN containers ON containers.item_id = requested.value
+    WHERE container_id != item_id
+    UNION ALL
+    SELECT requested_id, containers.item_id, containers.container_id, depth + 1, visited || containers.container_id || '/'
+    FROM containers INNER JOIN container_path ON containers.item_id = container_path.container_id
+    WHERE depth < :max_depth AND instr(visited, '/' || containers.container_id || '/') = 0
+)
+SELECT requested_id, 'container', container_id, depth FROM container_path
+UNION ALL SELECT requested.value, 'vehicle', container_id, 0 FROM json_each(:item_ids) AS requested INNER JOIN vehicles ON vehicles.item_id = requested.value
+UNION ALL SELECT requested.value, 'location', container_id, 0 FROM json_each(:item_ids) AS requested INNER JOIN locations ON locations.item_id = requested.value
+ORDER BY 1, 4
+"""
+
+def get_full_locations(cur, item_ids):
+    full_locations = {item_id: FullLocation([]) for item_id in item_ids}
+    vehicles = {}
+    res = cur.execute(full_locations_query, {'item_ids': json.dumps(list(full_locations)), 'max_depth': max_container_depth})
+    for item_id, kind, container_id, depth in res.fetchall():
+        if kind == 'container':
+            full_locations[item_id].container_path.append(container_id)
+        elif kind == 'location':
+            full_locations[item_id].location = container_id
+        else:
+            vehicles[item_id] = container_id
+    for item_id, vehicle in vehicles.items():
+        if full_locations[item_id].location is None:
+            full_locations[item_id].vehicle = vehicle
+    return full_locations
+
 @app.route('/inventory/api/v1.0/full-location/<string:item_id>', methods=['GET'])
 @check_auth_header
+@conditional_on_changes
 def get_full_location_of_item(item_id):
-    container_path = get_full_container_path_of_item(item_id)
-    con = sqlite3.connect(db_name)
+    con = get_db()
     cur = con.cursor()
-    res = cur.execute('SELECT container_id FROM locations WHERE item_id = ?', (item_id,))
-    container_ids = res.fetchone()
-    if container_ids is not None and len(container_ids) > 0:
-        return jsonify(FullLocation(container_path, location = container_ids[0]))
-    res = cur.execute('SELECT container_id FROM vehicles WHERE item_id = ?', (item_id,))
-    container_ids = res.fetchone()
-    if container_ids is not None and len(container_ids) > 0:
-        return jsonify(FullLocation(container_path, vehicle = container_ids[0]))
-    return jsonify(FullLocation(container_path))
+    return jsonify(get_full_locations(cur, [item_id])[item_id])
 
-def get_full_container_path_of_item(item_id):
-    con = sqlite3.connect(db_name)
+@app.route('/inventory/api/v1.0/full-locations', methods=['POST'])
+@check_auth_header
+def get_full_locations_of_items():
+    item_ids = request.json
+    if not isinstance(item_ids, list) or not all(isinstance(item_id, str) for item_id in item_ids):
+        abort(400)
+    if len(item_ids) > max_full_locations_batch_size:
+        abort(413)
+    con = get_db()
     cur = con.cursor()
-    res = cur.execute('SELECT container_id FROM containers WHERE item_id = ?', (item_id,))
-    container_ids = res.fetchone()
-    if container_ids is not None and len(container_ids) > 0:
-        return [container_ids[0]] + get_full_container_path_of_item(container_ids[0])
-    else:
-        return []
+    return jsonify(get_full_locations(cur, item_ids))
 
 @app.route('/inventory/api/v1.0/item-parent/<string:item_id>', methods=['GET'])
 @check_auth_header
+@conditional_on_changes
 def get_parent_of_item(item_id):
-    full_location = get_full_container_path_of_item(item_id)
-    if len(full_location) == 0:
+    con = get_db()
+    cur = con.cursor()
+    res = cur.execute('SELECT container_id FROM containers WHERE item_id = ?', (item_id,))
+    container_ids = res.fetchone()
+    if container_ids is None or len(container_ids) == 0:
         return jsonify('')
-    container_id = full_location[0]
-    return jsonify(container_id)
+    return jsonify(container_ids[0])
+
+def find_unknown_item_ids(sql_cursor, barcode_ids):
+    res = sql_cursor.execute('SELECT DISTINCT requested.value FROM json_each(:barcode_ids) AS requested LEFT JOIN items ON items.barcode_id = requested.value WHERE items.barcode_id IS NULL',
+            {'barcode_ids': json.dumps(barcode_ids)})
+    return [barcode_id for (barcode_id,) in res]
 
-def does_item_exist(sql_cursor, barcode_id):
-    res = sql_cursor.execute('SELECT count(*) FROM items WHERE barcode_id = ?', (barcode_id,))
-    return res.fetchone()[0] > 0
+def add_items_to_group(table, container_id):
+    item_ids = request.json
+    if not isinstance(item_ids, list) or len(item_ids) == 0 or not all(isinstance(item_id, str) for item_id in item_ids):
+        abort(400)
+    con = get_db()
+    cur = con.cursor()
+    unknown_item_ids = find_unknown_item_ids(cur, [container_id] + item_ids)
+    if len(unknown_item_ids) > 0:
+        return jsonify({'unknown_item_ids': unknown_item_ids}), 400
+    with con:
+        cur.executemany(f'INSERT OR REPLACE INTO {table} (container_id, item_id) VALUES (?, ?)', [(container_id, item_id) for item_id in item_ids])
+        record_changes(cur, table, [[item_id] for item_id in item_ids])
+    return '', 200
 
 @app.route('/inventory/api/v1.0/items-not-in-containers', methods=['GET'])
 @check_auth_header
+@conditional_on_changes
 def get_all_items_not_in_containers():
-    con = sqlite3.connect(db_name)
-    con.row_factory = row_to_item_factory
-    cur = con.cursor()
-    items = cur.execute('SELECT items.* FROM items LEFT JOIN containers ON barcode_id = item_id WHERE container_id IS NULL')
-    return jsonify(list(items))
+    return list_response('SELECT items.* FROM items LEFT JOIN containers ON barcode_id = item_id WHERE container_id IS NULL', {}, Item, 'barcode_id')
 
 @app.route('/inventory/api/v1.0/containers/<string:container_id>', methods=['GET'])
 @check_auth_header
+@conditional_on_changes
 def get_items_in_container(container_id):
     assert request.method == 'GET'
-    con = sqlite3.connect(db_name)
-    con.row_factory = lambda cursor, row: Item(*row)
+    con = get_db()
     cur = con.cursor()
     items = cur.execute('SELECT items.* FROM items INNER JOIN containers ON items.barcode_id = containers.item_id WHERE container_id = ?', (container_id,))
-    return jsonify(list(items))
+    return rows_response(Item, items.fetchall())
 
 @app.route('/inventory/api/v1.0/containers/<string:container_id>', methods=['POST'])
 @check_auth_header
 def add_items_to_container(container_id):
     assert request.method == 'POST'
-    item_ids = request.json
-    assert len(item_ids) >= 1
-    con = sqlite3.connect(db_name)
-    cur = con.cursor()
-    assert does_item_exist(cur, container_id)
-    for item_id in item_ids:
-        assert does_item_exist(cur, item_id)
-        cur.execute('INSERT OR REPLACE INTO containers (container_id, item_id) VALUES (:container_id, :item_id)', {'container_id': container_id, 'item_id': item_id})
-    con.commit()
-    return '', 200
+    return add_items_to_group('containers', container_id)
 
 @app.route('/inventory/api/v1.0/containers/<string:container_id>/<string:item_id>', methods=['DELETE'])
 @check_auth_header
 def remove_item_from_container(container_id, item_id):
     assert request.method == 'DELETE'
-    con = sqlite3.connect(db_name)
+    con = get_db()
     cur = con.cursor()
     cur.execute('DELETE FROM containers WHERE container_id = :container_id AND item_id = :item_id', {'container_id': container_id, 'item_id': item_id})
+    if cur.rowcount > 0:
+        record_changes(cur, 'containers', [[item_id]], deleted=True)
     con.commit()
     return '', 200
 
 @app.route('/inventory/api/v1.0/vehicles/<string:container_id>', methods=['GET'])
 @check_auth_header
+@conditional_on_changes
 def get_items_in_vehicles(container_id):
     assert request.method == 'GET'
-    con = sqlite3.connect(db_name)
-    con.row_factory = lambda cursor, row: Item(*row)
+    con = get_db()
     cur = con.cursor()
     items = cur.execute('SELECT items.* FROM items INNER JOIN vehicles ON items.barcode_id = vehicles.item_id WHERE container_id = ?', (container_id,))
-    return jsonify(list(items))
+    return rows_response(Item, items.fetchall())
 
 @app.route('/inventory/api/v1.0/vehicles/<string:container_id>', methods=['POST'])
 @check_auth_header
 def add_items_to_vehicle(container_id):
     assert request.method == 'POST'
-    item_ids = request.json
-    assert len(item_ids) >= 1
-    con = sqlite3.connect(db_name)
-    cur = con.cursor()
-    assert does_item_exist(cur, container_id)
-    for item_id in item_ids:
-        assert does_item_exist(cur, item_id)
-        cur.execute('INSERT OR REPLACE INTO vehicles (container_id, item_id) VALUES (:container_id, :item_id)', {'container_id': container_id, 'item_id': item_id})
-    con.commit()
-    return '', 200
+    return add_items_to_group('vehicles', container_id)
 
 @app.route('/inventory/api/v1.0/vehicles/<string:container_id>/<string:item_id>', methods=['DELETE'])
 @check_auth_header
 def remove_item_from_vehicle(container_id, item_id):
     assert request.method == 'DELETE'
-    con = sqlite3.connect(db_name)
+    con = get_db()
     cur = con.cursor()
     cur.execute('DELETE FROM vehicles WHERE container_id = :container_id AND item_id = :item_id', {'container_id': container_id, 'item_id': item_id})
+    if cur.rowcount > 0:
+        record_changes(cur, 'vehicles', [[item_id]], deleted=True)
     con.commit()
     return '', 200
 
 @app.route('/inventory/api/v1.0/locations/<string:container_id>', methods=['GET'])
 @check_auth_header
+@conditional_on_changes
 def get_items_in_location(container_id):
     assert request.method == 'GET'
-    con = sqlite3.connect(db_name)
-    con.row_factory = lambda cursor, row: Item(*row)
+    con = get_db()
     cur = con.cursor()
     items = cur.execute('SELECT items.* FROM items INNER JOIN locations ON items.barcode_id = locations.item_id WHERE container_id = ?', (container_id,))
-    return jsonify(list(items))
+    return rows_response(Item, items.fetchall())
 
 @app.route('/inventory/api/v1.0/locations/<string:container_id>', methods=['POST'])
 @check_auth_header
 def add_items_to_location(container_id):
     assert request.method == 'POST'
-    item_ids = request.json
-    assert len(item_ids) >= 1
-    con = sqlite3.connect(db_name)
-    cur = con.cursor()
-    assert does_item_exist(cur, container_id)
-    for item_id in item_ids:
-        assert does_item_exist(cur, item_id)
-        cur.execute('INSERT OR REPLACE INTO locations (container_id, item_id) VALUES (:container_id, :item_id)', {'container_id': container_id, 'item_id': item_id})
-    con.commit()
-    return '', 200
+    return add_items_to_group('locations', container_id)
 
 @app.route('/inventory/api/v1.0/locations/<string:container_id>/<string:item_id>', methods=['DELETE'])
 @check_auth_header
 def remove_item_from_location(container_id, item_id):
     assert request.method == 'DELETE'
-    con = sqlite3.connect(db_name)
+    con = get_db()
     cur = con.cursor()
     cur.execute('DELETE FROM locations WHERE container_id = :container_id AND item_id = :item_id', {'container_id': container_id, 'item_id': item_id})
+    if cur.rowcount > 0:
+        record_changes(cur, 'locations', [[item_id]], deleted=True)
     con.commit()
     return '', 200
 
+inventory_summary_query = """
+SELECT ids.item_id, inventoried_items.status, inventoried_items.notes, containers.container_id, vehicles.container_id, locations.container_id
+FROM (SELECT barcode_id AS item_id FROM items UNION SELECT item_id FROM inventoried_items WHERE inventory_id = :inventory_id) AS ids
+LEFT JOIN inventoried_items ON inventoried_items.inventory_id = :inventory_id AND inventoried_items.item_id = ids.item_id
+LEFT JOIN containers ON containers.item_id = ids.item_id
+LEFT JOIN vehicles ON vehicles.item_id = ids.item_id
+LEFT JOIN locations ON locations.item_id = ids.item_id
+"""
+
+uninventoried_status = 'UNINVENTORIED'
+summary_groups = ('containers', 'vehicles', 'locations')
+
+class InventoryEventSummary:
+    def __init__(self, inventory_id, sequence, rows):
+        self.inventory_id = inventory_id
+        self.sequence = sequence
+        self.placements = {}
+        self.statuses = {}
+        self.notes = {}
+        self.status_counts = {}
+        self.group_counts = {group: {} for group in summary_groups}
+        for item_id, status, notes, container_id, vehicle_id, location_id in rows:
+            self.placements[item_id] = (container_id, vehicle_id, location_id)
+            self.statuses[item_id] = status
+            self.notes[item_id] = notes
+            self.count(item_id, status, 1)
+
+    def count(self, item_id, status, delta):
+        key = uninventoried_status if status is None else status
+        counts = [self.status_counts]
+        for group, group_id in zip(summary_groups, self.placements[item_id]):
+            if group_id is not None:
+                counts.append(self.group_counts[group].setdefault(group_id, {}))
+        for count in counts:
+            count[key] = count.get(key, 0) + delta
+            if count[key] == 0:
+                del count[key]
+
+    def apply(self, item_id, status, notes):
+        if item_id not in self.placements:
+            return False
+        self.count(item_id, self.statuses[item_id], -1)
+        self.statuses[item_id] = status
+        self.notes[item_id] = notes
+        self.count(item_id, status, 1)
+        return True
+
+    def to_json(self, complete):
+        item_ids = sorted(self.statuses)
+        return {
+            'inventory_id': self.inventory_id,
+            'complete': complete,
+            'status_counts': dict(self.status_counts),
+            'containers': {group_id: dict(counts) for group_id, counts in self.group_counts['containers'].items() if len(counts) > 0},
+            'vehicles': {group_id: dict(counts) for group_id, counts in self.group_counts['vehicles'].items() if len(counts) > 0},
+            'locations': {group_id: dict(counts) for group_id, counts in self.group_counts['locations'].items() if len(counts) > 0},
+            'uninventoried_item_ids': [item_id for item_id in item_ids if self.statuses[item_id] is None],
+            'not_good_items': [asdict(InventoriedItem(self.inventory_id, item_id, self.statuses[item_id], self.notes[item_id])) for item_id in item_ids
+                    if self.statuses[item_id] not in (None, InventoryStatus.GOOD.value)],
+        }
+
+max_cached_inventory_summaries = 8
+inventory_summary_cache = {}
+inventory_summary_lock = threading.Lock()
+
+def summarize_inventory_event(cur, inventory_id, sequence):
+    return InventoryEventSummary(inventory_id, sequence, cur.execute(inventory_summary_query, {'inventory_id': inventory_id}).fetchall())
+
+def inventory_summary_sequence_names(inventory_id):
+    return catalog_sequence_tables + [f'inventoried_items/{inventory_id}']
+
+def record_inventoried_items(cur, inventoried_items):
+    # Returns the new sequence and, per inventory event, the sequence its summary
+    # had right before this write.
+    previous_sequences = {inventory_id: get_table_change_sequence(cur, inventory_summary_sequence_names(inventory_id))[0]
+            for inventory_id in {inventoried_item.inventory_id for inventoried_item in inventoried_items}}
+    seq = record_changes(cur, 'inventoried_items', [[inventoried_item.inventory_id, inventoried_item.item_id] for inventoried_item in inventoried_items])
+    return seq, previous_sequences
+
+def update_inventory_summaries(seq, previous_sequences, inventoried_items):
+    # Only a summary that was current right before this write can take its
+    # changes; one that missed a write (say, from another worker) is dropped and
+    # recomputed on the next read.
+    with inventory_summary_lock:
+        for inventory_id, previous_sequence in previous_sequences.items():
+            summary = inventory_summary_cache.get(inventory_id)
+            if summary is None:
+                continue
+            if summary.sequence != previous_sequence:
+                del inventory_summary_cache[inventory_id]
+                continue
+            for inventoried_item in inventoried_items:
+                if inventoried_item.inventory_id == inventory_id and not summary.apply(inventoried_item.item_id, inventoried_item.status, inventoried_item.notes):
+                    del inventory_summary_cache[inventory_id]
+                    break
+            else:
+                summary.sequence = seq
+
+def freeze_inventory_summary(cur, inventory_event):
+    if inventory_event.complete_unix_time is None:
+        cur.execute('DELETE FROM inventory_event_summaries WHERE inventory_id = ?', (inventory_event.id,))
+    else:
+        summary = summarize_inventory_event(cur, inventory_event.id, None).to_json(True)
+        cur.execute('INSERT OR REPLACE INTO inventory_event_summaries (inventory_id, summary) VALUES (?, ?)',
+                (inventory_event.id, json.dumps(summary, sort_keys=True, separators=(',', ':'))))
+    with inventory_summary_lock:
+        inventory_summary_cache.pop(inventory_event.id, None)
+
+@app.route('/inventory/api/v1.0/inventory-events/<int:inventory_id>/summary', methods=['GET'])
+@check_auth_header
+def get_inventory_event_summary(inventory_id):
+    con = get_db()
+    cur = con.cursor()
+    cur.execute('BEGIN')
+    try:
+        frozen = cur.execute('SELECT summary FROM inventory_event_summaries WHERE inventory_id = ?', (inventory_id,)).fetchone()
+        if frozen is not None:
+            return Response(frozen[0] + '\n', mimetype='application/json')
+        inventory_event = cur.execute('SELECT complete_unix_time FROM inventory_events WHERE id = ?', (inventory_id,)).fetchone()
+        if inventory_event is None:
+            abort(404)
+        complete = inventory_event[0] is not None
+        seq = get_table_change_sequence(cur, inventory_summary_sequence_names(inventory_id))[0]
+        with inventory_summary_lock:
+            summary = inventory_summary_cache.get(inventory_id)
+            if summary is not None and summary.sequence == seq:
+                return jsonify(summary.to_json(complete))
+        summary = summarize_inventory_event(cur, inventory_id, seq)
+    finally:
+        con.commit()
+    with inventory_summary_lock:
+        if inventory_id not in inventory_summary_cache and len(inventory_summary_cache) >= max_cached_inventory_summaries:
+            del inventory_summary_cache[next(iter(inventory_summary_cache))]
+        inventory_summary_cache[inventory_id] = summary
+        return jsonify(summary.to_json(complete))
+
 @app.route('/inventory/api/v1.0/inventory-events', methods=['GET'])
 @check_auth_header
 def get_inventory_events():
-    con = sqlite3.connect(db_name)
-    con.row_factory = lambda cursor, row: InventoryEvent(*row)
-    cur = con.cursor()
-    inventory_events = cur.execute('SELECT * FROM inventory_events')
-    return jsonify(list(inventory_events))
+    return list_response('SELECT * FROM inventory_events', {}, InventoryEvent, 'id')
 
 @app.route('/inventory/api/v1.0/inventory-events', methods=['POST'])
 @check_auth_header
 def create_new_inventory_event():
-    con = sqlite3.connect(db_name)
-    con.row_factory = lambda cursor, row: InventoryEvent(*row)
+    con = get_db()
     cur = con.cursor()
     current_time = int(time.time())
     cur.execute('INSERT INTO inventory_events (start_unix_time) VALUES (:current_time)', {'current_time': current_time})
+    record_changes(cur, 'inventory_events', [[cur.lastrowid]])
     con.commit()
+    cur.row_factory = lambda cursor, row: InventoryEvent(*row)
     res = cur.execute('SELECT * FROM inventory_events WHERE start_unix_time = :current_time', {'current_time': current_time})
     id = res.fetchone()
-    print(id)
     return jsonify(id)
 
 @app.route('/inventory/api/v1.0/inventory-events', methods=['PATCH'])
 @check_auth_header
 def update_inventory_event_complete_time_and_notes():
     inventory_event = InventoryEvent(**request.json)
-    con = sqlite3.connect(db_name)
+    con = get_db()
     cur = con.cursor()
     cur.execute('UPDATE inventory_events SET complete_unix_time = :complete_unix_time, notes = :notes WHERE id = :id',
             {'id': inventory_event.id, 'complete_unix_time': inventory_event.complete_unix_time, 'notes': inventory_event.notes})
+    if cur.rowcount > 0:
+        record_changes(cur, 'inventory_events', [[inventory_event.id]])
+        freeze_inventory_summary(cur, inventory_event)
     con.commit()
     return '', 200
 
 @app.route('/inventory/api/v1.0/inventoried-items-not-in-containers/<int:inventory_id>', methods=['GET'])
 @check_auth_header
 def get_all_inventoried_items_not_in_containers(inventory_id):
-    con = sqlite3.connect(db_name)
-    con.row_factory = lambda cursor, row: InventoriedItem(*row)
+    con = get_db()
     cur = con.cursor()
     inventoried_items = cur.execute('SELECT inventoried_items.* FROM inventoried_items LEFT JOIN containers ON inventoried_items.item_id = containers.item_id WHERE container_id IS NULL AND inventory_id = :inventory_id', {'inventory_id': inventory_id})
-    return jsonify(list(inventoried_items))
+    return rows_response(InventoriedItem, inventoried_items.fetchall())
 
 @app.route('/inventory/api/v1.0/inventoried-items-in-container/<int:inventory_id>/<string:container_id>', methods=['GET'])
 @check_auth_header
 def get_all_inventoried_items_in_container(inventory_id, container_id):
     assert request.method == 'GET'
-    con = sqlite3.connect(db_name)
-    con.row_factory = lambda cursor, row: InventoriedItem(*row)
+    con = get_db()
     cur = con.cursor()
     items = cur.execute('SELECT inventoried_items.* FROM inventoried_items INNER JOIN containers ON inventoried_items.item_id = containers.item_id WHERE container_id = :container_id AND inventory_id = :inventory_id', {'container_id': container_id, 'inventory_id': inventory_id})
-    return jsonify(list(items))
+    return rows_response(InventoriedItem, items.fetchall())
 
 @app.route('/inventory/api/v1.0/inventoried-items-uninventoried/<int:inventory_id>', methods=['GET'])
 @check_auth_header
 def get_all_uninventoried_items(inventory_id):
-    con = sqlite3.connect(db_name)
-    con.row_factory = lambda cursor, row: Item(*row)
-    cur = con.cursor()
-    items = cur.execute(
+    return list_response(
     'SELECT items.* FROM items INNER JOIN (SELECT barcode_id AS id FROM items EXCEPT SELECT item_id AS id FROM inventoried_items WHERE inventory_id = :inventory_id) ON barcode_id = id',
-    {'inventory_id': inventory_id})
-    return jsonify(list(items))
+    {'inventory_id': inventory_id}, Item, 'barcode_id')
 
 @app.route('/inventory/api/v1.0/inventoried-items-not-good/<int:inventory_id>', methods=['GET'])
 @check_auth_header
 def get_all_not_good_inventoried_items(inventory_id):
-    con = sqlite3.connect(db_name)
-    con.row_factory = lambda cursor, row: InventoriedItem(*row)
+    con = get_db()
     cur = con.cursor()
     inventoried_items = cur.execute('SELECT * FROM inventoried_items WHERE status != :good_inventory_status AND inventory_id = :inventory_id',
             {'good_inventory_status': InventoryStatus.GOOD.value, 'inventory_id': inventory_id})
-    return jsonify(list(inventoried_items))
+    return rows_response(InventoriedItem, inventoried_items.fetchall())
 
 @app.route('/inventory/api/v1.0/inventoried-items/<int:inventory_id>/<string:item_id>', methods=['GET'])
 @check_auth_header
 def get_inventoried_item(inventory_id, item_id):
-    con = sqlite3.connect(db_name)
+    con = get_db()
     con.row_factory = lambda cursor, row: InventoriedItem(*row)
     cur = con.cursor()
     inventoried_item = cur.execute('SELECT * FROM inventoried_items WHERE inventory_id = :inventory_id AND item_id = :item_id', {'inventory_id': inventory_id, 'item_id': item_id})
@@ -443,12 +1751,85 @@ def get_inventoried_item(inventory_id, item_id):
 @check_auth_header
 def add_inventoried_item():
     inventoried_item = InventoriedItem(**request.json)
-    con = sqlite3.connect(db_name)
+    con = get_db()
     cur = con.cursor()
     cur.execute('INSERT OR REPLACE INTO inventoried_items (inventory_id, item_id, status, notes) VALUES (:inventory_id, :item_id, :status, :notes)', asdict(inventoried_item))
+    seq, previous_sequences = record_inventoried_items(cur, [inventoried_item])
     con.commit()
+    update_inventory_summaries(seq, previous_sequences, [inventoried_item])
     return '', 200
 
+max_bulk_inventoried_items = 50000
+bulk_commit_batch_size = 1000
+inventory_status_values = {status.value for status in InventoryStatus}
+
+def validate_inventoried_item(row):
+    if not isinstance(row, dict):
+        return None, 'expected an object'
+    try:
+        inventoried_item = InventoriedItem(**row)
+    except TypeError:
+        return None, 'expected inventory_id, item_id, status and optional notes'
+    if not isinstance(inventoried_item.inventory_id, int) or isinstance(inventoried_item.inventory_id, bool):
+        return None, 'inventory_id must be an integer'
+    if not isinstance(inventoried_item.item_id, str):
+        return None, 'item_id must be a string'
+    if inventoried_item.status not in inventory_status_values:
+        return None, f'unknown status {inventoried_item.status!r}'
+    if inventoried_item.notes is not None and not isinstance(inventoried_item.notes, str):
+        return None, 'notes must be a string'
+    return inventoried_item, None
+
+def insert_inventoried_items(con, inventoried_items):
+    with con:
+        cur = con.cursor()
+        cur.executemany('INSERT OR REPLACE INTO inventoried_items (inventory_id, item_id, status, notes) VALUES (:inventory_id, :item_id, :status, :notes)',
+                [asdict(inventoried_item) for inventoried_item in inventoried_items])
+        seq, previous_sequences = record_inventoried_items(cur, inventoried_items)
+    update_inventory_summaries(seq, previous_sequences, inventoried_items)
+
+def read_ndjson_rows(stream):
+    for index, line in enumerate(stream):
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        try:
+            yield index, json.loads(line), None
+        except ValueError:
+            yield index, None, 'invalid JSON'
+
+@app.route('/inventory/api/v1.0/inventoried-items/bulk', methods=['POST'])
+@check_auth_header
+def add_inventoried_items():
+    if request.mimetype == 'application/x-ndjson':
+        rows = read_ndjson_rows(request.stream)
+    else:
+        inventoried_items = request.get_json(silent=True)
+        if not isinstance(inventoried_items, list):
+            abort(400)
+        if len(inventoried_items) > max_bulk_inventoried_items:
+            abort(413)
+        rows = ((index, row, None) for index, row in enumerate(inventoried_items))
+    con = get_db()
+    accepted = 0
+    errors = []
+    batch = []
+    for index, row, error in rows:
+        if error is None:
+            inventoried_item, error = validate_inventoried_item(row)
+        if error is not None:
+            errors.append({'index': index, 'error': error})
+            continue
+        batch.append(inventoried_item)
+        if len(batch) >= bulk_commit_batch_size:
+            insert_inventoried_items(con, batch)
+            accepted += len(batch)
+            batch = []
+    if len(batch) > 0:
+        insert_inventoried_items(con, batch)
+        accepted += len(batch)
+    return jsonify({'accepted': accepted, 'errors': errors})
+
 @app.route('/inventory/api/v1.0/toolshed-checkout', methods=['POST'])
 @check_auth_header
 def checkout_from_toolshed():
@@ -456,22 +1837,26 @@ def checkout_from_toolshed():
     toolshed_checkout = request.json
     toolshed_checkout['unix_time'] = int(time.time())
     toolshed_checkout = ToolshedCheckout(**toolshed_checkout)
-    con = sqlite3.connect(db_name)
-    cur = con.cursor()
-    cur.execute('INSERT OR REPLACE INTO toolshed_checkouts (item_id, user_id, unix_time) VALUES (:item_id, :user_id, :unix_time)',
-            {'item_id': toolshed_checkout.item_id, 'user_id': toolshed_checkout.user_id, 'unix_time': toolshed_checkout.unix_time})
-    con.commit()
+    def write_toolshed_checkout(cur):
+        cur.execute('INSERT OR REPLACE INTO toolshed_checkouts (item_id, user_id, unix_time) VALUES (:item_id, :user_id, :unix_time)',
+                {'item_id': toolshed_checkout.item_id, 'user_id': toolshed_checkout.user_id, 'unix_time': toolshed_checkout.unix_time})
+        checkout_id = cur.lastrowid
+        record_changes(cur, 'toolshed_checkouts', [[checkout_id]])
+        cur.execute('INSERT INTO open_toolshed_checkouts (checkout_id, item_id, user_id) VALUES (:checkout_id, :item_id, :user_id)',
+                {'checkout_id': checkout_id, 'item_id': toolshed_checkout.item_id, 'user_id': toolshed_checkout.user_id})
+        record_changes(cur, 'open_toolshed_checkouts', [[checkout_id]])
+    submit_write(write_toolshed_checkout)
     return '', 200
 
 @app.route('/inventory/api/v1.0/toolshed-checkout/<string:barcode_id>/last-outstanding', methods=['GET'])
 @check_auth_header
 def get_last_outstanding_checkout(barcode_id):
-    con = sqlite3.connect(db_name)
+    con = get_db()
     con.row_factory = lambda cursor, row: ToolshedCheckout(*row)
     cur = con.cursor()
-    res = cur.execute('SELECT toolshed_checkouts.* FROM toolshed_checkouts LEFT JOIN toolshed_checkins ON toolshed_checkouts.checkout_id = toolshed_checkins.checkout_id WHERE toolshed_checkins.checkout_id IS NULL AND toolshed_checkouts.item_id = :item_id AND toolshed_checkouts.checkout_id = (SELECT checkout_id FROM toolshed_checkouts WHERE item_id = :item_id ORDER BY unix_time DESC LIMIT 1)', {'item_id': barcode_id})
+    res = cur.execute('SELECT toolshed_checkouts.* FROM open_toolshed_checkouts INNER JOIN toolshed_checkouts ON open_toolshed_checkouts.checkout_id = toolshed_checkouts.checkout_id \
+            WHERE open_toolshed_checkouts.checkout_id = (SELECT checkout_id FROM toolshed_checkouts WHERE item_id = :item_id ORDER BY unix_time DESC LIMIT 1)', {'item_id': barcode_id})
     outstanding_checkout = res.fetchone()
-    print(outstanding_checkout)
     return jsonify(outstanding_checkout)
 
 @app.route('/inventory/api/v1.0/toolshed-checkin', methods=['POST'])
@@ -479,71 +1864,65 @@ def get_last_outstanding_checkout(barcode_id):
 def checkin_to_toolshed():
     assert request.method == 'POST'
     toolshed_checkin = request.json
-    print(toolshed_checkin)
     toolshed_checkin['unix_time'] = int(time.time())
     toolshed_checkin = ToolshedCheckin(**toolshed_checkin)
-    con = sqlite3.connect(db_name)
-    cur = con.cursor()
-    cur.execute('INSERT OR REPLACE INTO toolshed_checkins (checkout_id, item_id, user_id, unix_time, override_justification, description) VALUES (:checkout_id, :item_id, :user_id, :unix_time, :override_justification, :description)', asdict(toolshed_checkin))
-    con.commit()
+    def write_toolshed_checkin(cur):
+        cur.execute('INSERT OR REPLACE INTO toolshed_checkins (checkout_id, item_id, user_id, unix_time, override_justification, description) VALUES (:checkout_id, :item_id, :user_id, :unix_time, :override_justification, :description)', asdict(toolshed_checkin))
+        record_changes(cur, 'toolshed_checkins', [[cur.lastrowid]])
+        cur.execute('DELETE FROM open_toolshed_checkouts WHERE checkout_id = :checkout_id', {'checkout_id': toolshed_checkin.checkout_id})
+        if cur.rowcount > 0:
+            record_changes(cur, 'open_toolshed_checkouts', [[toolshed_checkin.checkout_id]], deleted=True)
+    submit_write(write_toolshed_checkin)
     return '', 200
 
 @app.route('/inventory/api/v1.0/users/<string:user_id>/toolshed-checkout-outstanding', methods=['GET'])
 @check_auth_header
 def get_items_checked_out_by_user(user_id):
-    con = sqlite3.connect(db_name)
-    con.row_factory = row_to_item_factory
+    con = get_db()
     cur = con.cursor()
-    items = cur.execute('SELECT items.* FROM toolshed_checkouts \
-            LEFT JOIN toolshed_checkins ON toolshed_checkouts.checkout_id = toolshed_checkins.checkout_id \
-            INNER JOIN items ON toolshed_checkouts.item_id = items.barcode_id \
-            WHERE toolshed_checkins.checkout_id IS NULL AND toolshed_checkouts.user_id = ?', (user_id,))
-    return jsonify(list(items))
+    items = cur.execute('SELECT items.* FROM open_toolshed_checkouts \
+            INNER JOIN items ON open_toolshed_checkouts.item_id = items.barcode_id \
+            WHERE open_toolshed_checkouts.user_id = ?', (user_id,))
+    return rows_response(Item, items.fetchall())
 
 @app.route('/inventory/api/v1.0/users-toolshed-checkout-outstanding', methods=['GET'])
 @check_auth_header
 def get_users_with_outstanding_toolshed_checkouts():
-    con = sqlite3.connect(db_name)
-    con.row_factory = lambda cursor, row: User(*row)
+    con = get_db()
     cur = con.cursor()
-    users = cur.execute('SELECT DISTINCT users.* FROM toolshed_checkouts \
-            LEFT JOIN toolshed_checkins ON toolshed_checkouts.checkout_id = toolshed_checkins.checkout_id \
-            INNER JOIN users ON toolshed_checkouts.user_id = users.barcode_id \
-            WHERE toolshed_checkins.checkout_id IS NULL')
-    return jsonify(list(users))
+    users = cur.execute('SELECT users.* FROM users WHERE barcode_id IN (SELECT user_id FROM open_toolshed_checkouts)')
+    return rows_response(User, users.fetchall())
 
 @app.route('/inventory/api/v1.0/users/<string:barcode_id>', methods=['GET'])
 @check_auth_header
 def get_user(barcode_id):
-    con = sqlite3.connect(db_name)
-    con.row_factory = lambda cursor, row: User(*row)
-    cur = con.cursor()
-    [user] = cur.execute('SELECT * FROM users WHERE barcode_id = ?', (barcode_id,))
-    print(user)
-    retval = jsonify(user)
-    print(retval)
-    return retval
+    user = user_cache.get(barcode_id, lambda: load_user(barcode_id), get_table_change_sequence(get_db().cursor(), ['users'])[0])
+    if user is None:
+        abort(404)
+    return jsonify(user)
 
 @app.route('/inventory/api/v1.0/user-picture/<string:user_id>', methods=['GET'])
 @check_auth_header
 def get_user_picture(user_id):
-    con = sqlite3.connect(db_name)
-    cur = con.cursor()
-    res = cur.execute('SELECT picture_path FROM users WHERE barcode_id = ?', (user_id,))
-    [picture_path] = res.fetchone()
-    return send_from_directory(picture_directory, picture_path)
+    user = user_cache.get(user_id, lambda: load_user(user_id), get_table_change_sequence(get_db().cursor(), ['users'])[0])
+    if user is None:
+        abort(404)
+    return send_picture(user.picture_path)
 
 @app.route('/inventory/api/v1.0/user-picture/<string:user_id>', methods=['POST'])
 @check_auth_header
 def uploadUserPicture(user_id):
     assert request.method == 'POST'
-    unique_filename = str(uuid.uuid4())
-    file = request.files['picture']
-    file.save(os.path.join(picture_directory, unique_filename))
-    con = sqlite3.connect(db_name)
+    picture_path = save_picture(request.files['picture'])
+    con = get_db()
     cur = con.cursor()
-    cur.execute('UPDATE users SET picture_path = :picture_path WHERE barcode_id = :barcode_id', {'barcode_id': user_id, 'picture_path': unique_filename})
+    cur.execute('UPDATE users SET picture_path = :picture_path WHERE barcode_id = :barcode_id', {'barcode_id': user_id, 'picture_path': picture_path})
+    if cur.rowcount > 0:
+        record_changes(cur, 'users', [[user_id]])
     con.commit()
+    user_cache.invalidate(user_id)
+    if Image is not None:
+        queue_picture_variants(picture_path)
     return '', 200
 
 @app.route('/inventory/api/v1.0/user-checkin/<string:user_id>', methods=['POST'])
@@ -551,10 +1930,11 @@ def uploadUserPicture(user_id):
 def checkin_user(user_id):
     assert request.method == 'POST'
     unix_time = int(time.time())
-    con = sqlite3.connect(db_name)
-    cur = con.cursor()
-    cur.execute('INSERT OR REPLACE INTO user_checkins (user_id, unix_time) VALUES (:user_id, :unix_time)', {'user_id': user_id, 'unix_time': unix_time})
-    con.commit()
+    def write_checkin(cur):
+        cur.execute('INSERT OR REPLACE INTO user_checkins (user_id, unix_time) VALUES (:user_id, :unix_time)', {'user_id': user_id, 'unix_time': unix_time})
+        record_changes(cur, 'user_checkins', [[cur.lastrowid]])
+        update_user_presence(cur, user_id, 'checkin', unix_time)
+    submit_write(write_checkin)
     return '', 200
 
 @app.route('/inventory/api/v1.0/user-checkout/<string:user_id>', methods=['POST'])
@@ -562,39 +1942,641 @@ def checkin_user(user_id):
 def checkout_user(user_id):
     assert request.method == 'POST'
     unix_time = int(time.time())
-    con = sqlite3.connect(db_name)
-    cur = con.cursor()
-    cur.execute('INSERT OR REPLACE INTO user_checkouts (user_id, unix_time) VALUES (:user_id, :unix_time)', {'user_id': user_id, 'unix_time': unix_time})
-    con.commit()
+    def write_checkout(cur):
+        cur.execute('INSERT OR REPLACE INTO user_checkouts (user_id, unix_time) VALUES (:user_id, :unix_time)', {'user_id': user_id, 'unix_time': unix_time})
+        record_changes(cur, 'user_checkouts', [[cur.lastrowid]])
+        update_user_presence(cur, user_id, 'checkout', unix_time)
+    submit_write(write_checkout)
     return '', 200
 
 @app.route('/inventory/api/v1.0/users-checkedin/', methods=['GET'])
 def get_checked_in_users():
-    con = sqlite3.connect(db_name)
-    con.row_factory = lambda cursor, row: User(*row)
+    con = get_db()
     cur = con.cursor()
-    users = cur.execute('SELECT users.* FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY unix_time DESC) AS row_num FROM (SELECT "checkin" AS type, * FROM user_checkins UNION SELECT "checkout" AS type, * FROM user_checkouts)) INNER JOIN users ON user_id = barcode_id WHERE row_num == 1 AND type == "checkin"')
-    users = list(users)
-    return jsonify(users)
+    users = cur.execute("SELECT users.* FROM user_presence INNER JOIN users ON user_id = barcode_id WHERE state = 'checkin'")
+    return rows_response(User, users.fetchall())
 
 @app.route('/inventory/api/v1.0/users/', methods=['POST'])
 @check_auth_header
 def create_user_without_picture():
     assert request.method == 'POST'
-    con = sqlite3.connect(db_name)
+    con = get_db()
     cur = con.cursor()
     user = request.json
     user = User(**user)
     cur.execute('INSERT OR REPLACE INTO users (barcode_id, name, company, user_type, description, initial_checkin_info) VALUES (:barcode_id, :name, :company, :user_type, :description, :initial_checkin_info)', asdict(user))
+    record_changes(cur, 'users', [[user.barcode_id]])
     con.commit()
+    user_cache.invalidate(user.barcode_id)
     return '', 200
 
+default_search_limit = 20
+max_search_limit = 100
+search_tables = {
+    'items': (Item, 'items_search', 'bm25(items_search, 5.0, 5.0, 10.0, 1.0)', ['barcode_id', 'short_id', 'name', 'description']),
+    'users': (User, 'users_search', 'bm25(users_search, 5.0, 10.0, 2.0)', ['barcode_id', 'name', 'company']),
+}
+
+def search_table(cur, table, terms, limit, use_index):
+    row_type, index_table, rank, columns = search_tables[table]
+    if use_index:
+        # Every term must match the start of a token, so "gen dew" finds "Generator, Dewalt".
+        res = cur.execute(f'SELECT {table}.* FROM {index_table} INNER JOIN {table} ON {table}.rowid = {index_table}.rowid \
+                WHERE {index_table} MATCH :query ORDER BY {rank} LIMIT :limit',
+                {'query': ' '.join(f'"{term}"*' for term in terms), 'limit': limit})
+    else:
+        conditions = ' AND '.join('(' + ' OR '.join(f"{column} LIKE :term{i} ESCAPE '\\'" for column in columns) + ')' for i in range(len(terms)))
+        params = {f'term{i}': '%' + term.replace('_', '\\_') + '%' for i, term in enumerate(terms)}
+        res = cur.execute(f'SELECT * FROM {table} WHERE {conditions} ORDER BY name LIMIT :limit', dict(params, limit=limit))
+    return rows_to_objects([field.name for field in fields(row_type)], res.fetchall())
+
+@app.route('/inventory/api/v1.0/search', methods=['GET'])
+@check_auth_header
+def search():
+    terms = re.findall(r'\w+', request.args.get('q', ''))
+    search_type = request.args.get('type', 'all')
+    limit = request.args.get('limit', default_search_limit, type=int)
+    if search_type not in ('all', 'items', 'users') or limit <= 0:
+        abort(400)
+    tables = list(search_tables) if search_type == 'all' else [search_type]
+    if len(terms) == 0:
+        return jsonify({table: [] for table in tables})
+    con = get_db()
+    cur = con.cursor()
+    use_index = search_index_exists(cur)
+    return jsonify({table: search_table(cur, table, terms, min(limit, max_search_limit), use_index) for table in tables})
+
+# Columns an import sets, the statement that upserts one row, and the key
+# recorded in the change log. Imports keep the picture of an existing item or user.
+catalog_tables = {
+    'items': (['barcode_id', 'short_id', 'name', 'description'],
+            'INSERT OR REPLACE INTO items (barcode_id, short_id, name, picture_path, description) \
+                VALUES (:barcode_id, :short_id, :name, (SELECT picture_path FROM items WHERE barcode_id = :barcode_id), :description)', 'barcode_id'),
+    'users': (['barcode_id', 'name', 'company', 'user_type', 'description', 'initial_checkin_info'],
+            'INSERT OR REPLACE INTO users (barcode_id, name, company, picture_path, user_type, description, initial_checkin_info) \
+                VALUES (:barcode_id, :name, :company, (SELECT picture_path FROM users WHERE barcode_id = :barcode_id), :user_type, :description, :initial_checkin_info)', 'barcode_id'),
+    'containers': (['container_id', 'item_id'], 'INSERT OR REPLACE INTO containers (container_id, item_id) VALUES (:container_id, :item_id)', 'item_id'),
+    'vehicles': (['container_id', 'item_id'], 'INSERT OR REPLACE INTO vehicles (container_id, item_id) VALUES (:container_id, :item_id)', 'item_id'),
+    'locations': (['container_id', 'item_id'], 'INSERT OR REPLACE INTO locations (container_id, item_id) VALUES (:container_id, :item_id)', 'item_id'),
+}
+catalog_formats = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+import_batch_size = 1000
+max_import_job_errors = 100
+import_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='catalog-import')
+
+def read_catalog_rows(file, catalog_format):
+    if catalog_format == 'ndjson':
+        yield from read_ndjson_rows(file)
+        return
+    for index, row in enumerate(csv.DictReader(file)):
+        # CSV has no null, so empty fields are imported as missing values.
+        yield index, {column: None if value == '' else value for column, value in row.items()}, None
+
+def validate_catalog_row(kind, row):
+    columns, _, key_column = catalog_tables[kind]
+    if not isinstance(row, dict):
+        return None, 'expected an object'
+    required_columns = [key_column, 'container_id'] if key_column == 'item_id' else [key_column]
+    for column in required_columns:
+        if not isinstance(row.get(column), str) or len(row[column]) == 0:
+            return None, f'{column} is required'
+    values = {column: row.get(column) for column in columns}
+    for column, value in values.items():
+        if value is not None and not isinstance(value, (str, int)):
+            return None, f'{column} must be a string'
+    return values, None
+
+def import_catalog_batch(con, job_id, kind, batch, progress):
+    _, statement, key_column = catalog_tables[kind]
+    with con:
+        cur = con.cursor()
+        if key_column == 'item_id':
+            unknown_item_ids = set(find_unknown_item_ids(cur, [row[column] for _, row in batch for column in ('container_id', 'item_id')]))
+            for index, row in batch:
+                for column in ('container_id', 'item_id'):
+                    if row[column] in unknown_item_ids:
+                        add_import_error(progress, index, f'unknown {column} {row[column]!r}')
+                        break
+            batch = [(index, row) for index, row in batch if row['container_id'] not in unknown_item_ids and row['item_id'] not in unknown_item_ids]
+        if len(batch) > 0:
+            cur.executemany(statement, [row for _, row in batch])
+            record_changes(cur, kind, [[row[key_column]] for _, row in batch])
+        progress['rows_imported'] += len(batch)
+        update_import_job(cur, job_id, 'running', progress)
+    if kind == 'items':
+        item_cache.clear()
+    elif kind == 'users':
+        user_cache.clear()
+
+def add_import_error(progress, index, error):
+    progress['error_count'] += 1
+    if len(progress['errors']) < max_import_job_errors:
+        progress['errors'].append({'index': index, 'error': error})
+
+def update_import_job(cur, job_id, state, progress, message=None):
+    cur.execute('UPDATE import_jobs SET state = :state, rows_read = :rows_read, rows_imported = :rows_imported, error_count = :error_count, errors = :errors, \
+            message = :message, finished_unix_time = :finished_unix_time WHERE id = :id',
+            {'id': job_id, 'state': state, 'rows_read': progress['rows_read'], 'rows_imported': progress['rows_imported'], 'error_count': progress['error_count'],
+            'errors': json.dumps(progress['errors']), 'message': message, 'finished_unix_time': None if state == 'running' else int(time.time())})
+
+def create_import_job(con, kind):
+    job_id = uuid.uuid4().hex
+    with con:
+        con.execute("INSERT INTO import_jobs (id, kind, state, created_unix_time) VALUES (?, ?, 'queued', ?)", (job_id, kind, int(time.time())))
+    return job_id
+
+def run_import_job(database, job_id, kind, path, catalog_format):
+    con = connect_db(database)
+    progress = {'rows_read': 0, 'rows_imported': 0, 'error_count': 0, 'errors': []}
+    try:
+        with open(path, 'r', newline='', encoding='utf-8-sig') as file:
+            batch = []
+            for index, row, error in read_catalog_rows(file, catalog_format):
+                progress['rows_read'] += 1
+                if error is None:
+                    row, error = validate_catalog_row(kind, row)
+                if error is not None:
+                    add_import_error(progress, index, error)
+                    continue
+                batch.append((index, row))
+                if len(batch) >= import_batch_size:
+                    import_catalog_batch(con, job_id, kind, batch, progress)
+                    batch = []
+            import_catalog_batch(con, job_id, kind, batch, progress)
+        with con:
+            update_import_job(con.cursor(), job_id, 'done', progress)
+    except Exception as e:
+        logger.exception('Import job %s failed', job_id)
+        with con:
+            update_import_job(con.cursor(), job_id, 'failed', progress, str(e))
+    finally:
+        con.close()
+    return progress
+
+def run_spooled_import_job(database, job_id, kind, path, catalog_format):
+    try:
+        run_import_job(database, job_id, kind, path, catalog_format)
+    finally:
+        os.remove(path)
+
+def fail_interrupted_import_jobs(database):
+    con = connect_db(database)
+    try:
+        with con:
+            con.execute("UPDATE import_jobs SET state = 'failed', message = 'interrupted by a server restart', finished_unix_time = ? WHERE state IN ('queued', 'running')",
+                    (int(time.time()),))
+    finally:
+        con.close()
+
+def catalog_export_query(kind):
+    if kind in ('items', 'users'):
+        columns = [field.name for field in fields(Item if kind == 'items' else User)]
+    else:
+        columns = ['container_id', 'item_id']
+    key_column = catalog_tables[kind][2]
+    return f'SELECT {key_column}, {", ".join(columns)} FROM {kind} ORDER BY {key_column}', columns
+
+def generate_csv_rows(pool, con, res, selected_columns):
+    try:
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(selected_columns)
+        while rows := res.fetchmany():
+            writer.writerows(row[1:] for row in rows)
+            yield output.getvalue().encode()
+            output.seek(0)
+            output.truncate()
+        yield output.getvalue().encode()
+    finally:
+        pool.release(con)
+
+def generate_catalog_export(pool, con, kind, catalog_format):
+    query, columns = catalog_export_query(kind)
+    try:
+        cur = con.cursor()
+        cur.arraysize = stream_batch_size
+        res = cur.execute(query)
+    except BaseException:
+        pool.release(con)
+        raise
+    if catalog_format == 'csv':
+        return generate_csv_rows(pool, con, res, columns)
+    return generate_ndjson_rows(pool, con, res, columns)
+
+def write_catalog_export(database, kind, catalog_format, output):
+    pool = ConnectionPool(database, 1)
+    try:
+        for chunk in generate_catalog_export(pool, pool.acquire(), kind, catalog_format):
+            output.write(chunk)
+    finally:
+        pool.close()
+
+def requested_catalog_format():
+    catalog_format = request.args.get('format')
+    if catalog_format is None:
+        catalog_format = {mimetype: name for name, mimetype in catalog_formats.items()}.get(request.mimetype, 'ndjson')
+    if catalog_format not in catalog_formats:
+        abort(400)
+    return catalog_format
+
+@app.route('/inventory/api/v1.0/import/<string:kind>', methods=['POST'])
+@check_auth_header
+def import_catalog(kind):
+    if kind not in catalog_tables:
+        abort(404)
+    catalog_format = requested_catalog_format()
+    # Spool the body so the request can finish while the job works through it.
+    fd, path = tempfile.mkstemp(suffix='.import')
+    try:
+        with os.fdopen(fd, 'wb') as spool:
+            while chunk := request.stream.read(picture_chunk_size):
+                spool.write(chunk)
+        job_id = create_import_job(get_db(), kind)
+    except BaseException:
+        os.remove(path)
+        raise
+    import_executor.submit(run_spooled_import_job, db_name, job_id, kind, path, catalog_format)
+    response = jsonify({'job_id': job_id})
+    response.status_code = 202
+    response.headers['Location'] = f'/inventory/api/v1.0/import-jobs/{job_id}'
+    return response
+
+@app.route('/inventory/api/v1.0/import-jobs/<string:job_id>', methods=['GET'])
+@check_auth_header
+def get_import_job(job_id):
+    con = get_db()
+    cur = con.cursor()
+    res = cur.execute('SELECT id, kind, state, rows_read, rows_imported, error_count, errors, message, created_unix_time, finished_unix_time FROM import_jobs WHERE id = ?', (job_id,))
+    row = res.fetchone()
+    if row is None:
+        abort(404)
+    job = dict(zip([column[0] for column in res.description], row))
+    job['errors'] = json.loads(job['errors'])
+    return jsonify(job)
+
+@app.route('/inventory/api/v1.0/export/<string:kind>', methods=['GET'])
+@check_auth_header
+def export_catalog(kind):
+    if kind not in catalog_tables:
+        abort(404)
+    catalog_format = requested_catalog_format()
+    # Streamed like list_response, so the generator owns its connection.
+    pool = get_connection_pool()
+    response = Response(generate_catalog_export(pool, pool.acquire(), kind, catalog_format), mimetype=catalog_formats[catalog_format])
+    response.headers['Content-Disposition'] = f'attachment; filename={kind}.{catalog_format}'
+    return response
+
+@app.route('/metrics', methods=['GET'])
+@check_auth_header
+def get_metrics():
+    if metrics_directory is None:
+        metrics, cache_counts = collect_metrics(), collect_cache_metrics(lookup_caches)
+    else:
+        metrics, cache_counts = collect_worker_metrics()
+    return Response(format_metrics(metrics) + format_cache_metrics(cache_counts), mimetype='text/plain; version=0.0.4')
+
+max_sync_changes = 5000
+
+@app.route('/inventory/api/v1.0/sync', methods=['GET'])
+@check_auth_header
+def sync_changes():
+    since = request.args.get('since', type=int)
+    limit = min(request.args.get('limit', max_sync_changes, type=int), max_sync_changes)
+    if since is None or limit <= 0:
+        abort(400)
+    con = get_db()
+    cur = con.cursor()
+    cur.execute('BEGIN')
+    seq, compacted_through = cur.execute('SELECT seq, compacted_through FROM change_sequence WHERE id = 0').fetchone()
+    if since < compacted_through:
+        con.commit()
+        return jsonify({'sequence': seq, 'full_resync': True, 'has_more': False, 'upserts': {}, 'deletions': {}})
+    res = cur.execute('SELECT seq FROM change_log WHERE seq > :since ORDER BY seq LIMIT 1 OFFSET :limit', {'since': since, 'limit': limit})
+    next_seq = res.fetchone()
+    through = seq if next_seq is None else max(next_seq[0] - 1, since + 1)
+    changed_keys = {}
+    res = cur.execute('SELECT table_name, row_key FROM change_log WHERE seq > :since AND seq <= :through', {'since': since, 'through': through})
+    for table_name, row_key in res:
+        changed_keys.setdefault(table_name, []).append(row_key)
+    upserts = {}
+    deletions = {}
+    for table_name, row_keys in changed_keys.items():
+        key_columns = sync_tables[table_name]
+        join_condition = ' AND '.join(f"{table_name}.{column} = json_extract(changed.value, '$[{i}]')" for i, column in enumerate(key_columns))
+        selected_columns = f'{table_name}.rowid AS rowid, {table_name}.*' if key_columns == ['rowid'] else f'{table_name}.*'
+        res = cur.execute(f'SELECT changed.value, {selected_columns} FROM json_each(:row_keys) AS changed INNER JOIN {table_name} ON {join_condition}',
+                {'row_keys': '[' + ','.join(row_keys) + ']'})
+        column_names = [column[0] for column in res.description[1:]]
+        rows = res.fetchall()
+        if len(rows) > 0:
+            upserts[table_name] = [dict(zip(column_names, row[1:])) for row in rows]
+        found_keys = {row[0] for row in rows}
+        deleted_keys = [json.loads(row_key) for row_key in row_keys if row_key not in found_keys]
+        if len(deleted_keys) > 0:
+            deletions[table_name] = deleted_keys
+    con.commit()
+    return jsonify({'sequence': through, 'full_resync': False, 'has_more': next_seq is not None, 'upserts': upserts, 'deletions': deletions})
+
+backup_interval_seconds = float(os.environ.get('INVENTORY_BACKUP_INTERVAL_HOURS', '24')) * 60 * 60
+backup_retention_count = int(os.environ.get('INVENTORY_BACKUP_RETENTION', '7'))
+backup_pages_per_step = int(os.environ.get('INVENTORY_BACKUP_PAGES_PER_STEP', '1024'))
+backup_step_sleep_seconds = float(os.environ.get('INVENTORY_BACKUP_STEP_SLEEP_MS', '10')) / 1000
+max_backup_restarts = 3
+backup_check_interval_seconds = 60
+backup_name_format = '%Y%m%dT%H%M%SZ'
+backup_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='backup')
+backup_scheduler = None
+
+class BackupInProgress(Exception):
+    pass
+
+class BackupRestarted(Exception):
+    pass
+
+def backup_lock(directory):
+    # Held for the whole backup, so only one process (of any worker or manage.py)
+    # writes snapshots at a time.
+    lock_file = open(os.path.join(directory, '.lock'), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        raise BackupInProgress()
+    return lock_file
+
+def write_backup_status(path, status):
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as status_file:
+        json.dump(status, status_file)
+    os.replace(temporary_path, path)
+
+def backup_sqlite_database(database, destination, status, status_path):
+    source = sqlite3.connect(database, timeout=busy_timeout_seconds)
+    target = sqlite3.connect(destination)
+    restarts = 0
+    def progress(step_status, remaining, total):
+        nonlocal restarts
+        if status['pages_remaining'] is not None and remaining > status['pages_remaining']:
+            restarts += 1
+            if restarts > max_backup_restarts:
+                raise BackupRestarted()
+        status.update(pages_total=total, pages_remaining=remaining)
+        write_backup_status(status_path, status)
+        time.sleep(backup_step_sleep_seconds)
+    try:
+        try:
+            source.backup(target, pages=backup_pages_per_step, progress=progress)
+        except BackupRestarted:
+            # A write from another connection restarts a stepped backup. When
+            # writes keep coming, copy the rest in one step instead: in WAL mode
+            # that only holds a read snapshot, so writers still are not blocked.
+            logger.warning('Backup restarted %d times by concurrent writes, finishing in a single step', restarts)
+            source.backup(target)
+        status.update(pages_remaining=0, restarts=restarts)
+        result = target.execute('PRAGMA quick_check').fetchone()[0]
+        if result != 'ok':
+            raise sqlite3.DatabaseError(f'backup failed quick_check: {result}')
+    finally:
+        target.close()
+        source.close()
+
+def snapshot_pictures(pictures, destination, previous):
+    # Stored pictures are content-addressed and never modified, so a hard link is
+    # a complete copy that costs no space. Variants are regenerated on demand.
+    linked = 0
+    copied = 0
+    for directory, subdirectories, filenames in os.walk(pictures):
+        relative_directory = os.path.relpath(directory, pictures)
+        if relative_directory == '.' and 'variants' in subdirectories:
+            subdirectories.remove('variants')
+        os.makedirs(os.path.join(destination, relative_directory), exist_ok=True)
+        for filename in filenames:
+            if filename.endswith('.tmp'):
+                continue
+            source = os.path.join(directory, filename)
+            target = os.path.join(destination, relative_directory, filename)
+            candidates = [source]
+            if previous is not None:
+                candidates.append(os.path.join(previous, relative_directory, filename))
+            for candidate in candidates:
+                try:
+                    os.link(candidate, target)
+                    linked += 1
+                    break
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+            else:
+                shutil.copy2(source, target)
+                copied += 1
+    return linked, copied
+
+def completed_backups(directory):
+    return sorted(name for name in os.listdir(directory) if os.path.exists(os.path.join(directory, name, 'backup.json')))
+
+def last_backup_unix_time(directory):
+    backups = completed_backups(directory)
+    if len(backups) == 0:
+        return None
+    with open(os.path.join(directory, backups[-1], 'backup.json')) as status_file:
+        return json.load(status_file)['started_unix_time']
+
+def unique_backup_name(directory, name):
+    # Two backups can start in the same second (say, manage.py right after a
+    # scheduled one), so later ones get a suffix.
+    candidate = name
+    suffix = 1
+    while os.path.exists(os.path.join(directory, candidate)) or os.path.exists(os.path.join(directory, candidate + '.partial')):
+        candidate = f'{name}-{suffix}'
+        suffix += 1
+    return candidate
+
+def create_backup(database, pictures, directory, retention_count=backup_retention_count, name=None, interval_seconds=None):
+    # With interval_seconds, nothing is done unless the last backup is at least
+    # that old. The check is made under the lock so that of several workers'
+    # schedulers only one takes the backup.
+    os.makedirs(directory, exist_ok=True)
+    lock_file = backup_lock(directory)
+    try:
+        if interval_seconds is not None:
+            last_backup_time = last_backup_unix_time(directory)
+            if last_backup_time is not None and time.time() - last_backup_time < interval_seconds:
+                return None
+        if name is None:
+            name = time.strftime(backup_name_format, time.gmtime())
+        name = unique_backup_name(directory, name)
+        partial_path = os.path.join(directory, name + '.partial')
+        try:
+            return write_backup(database, pictures, directory, retention_count, name, partial_path)
+        except BaseException:
+            shutil.rmtree(partial_path, ignore_errors=True)
+            raise
+    finally:
+        lock_file.close()
+
+def write_backup(database, pictures, directory, retention_count, name, partial_path):
+    os.makedirs(partial_path)
+    status_path = os.path.join(partial_path, 'progress.json')
+    status = {'name': name, 'state': 'running', 'started_unix_time': int(time.time()), 'pages_total': None, 'pages_remaining': None}
+    write_backup_status(status_path, status)
+    backup_sqlite_database(database, os.path.join(partial_path, os.path.basename(database)), status, status_path)
+    if pictures is not None:
+        previous = completed_backups(directory)
+        previous_pictures = os.path.join(directory, previous[-1], 'pictures') if len(previous) > 0 else None
+        status['pictures_linked'], status['pictures_copied'] = snapshot_pictures(pictures, os.path.join(partial_path, 'pictures'), previous_pictures)
+    status.update(state='done', finished_unix_time=int(time.time()))
+    os.remove(status_path)
+    write_backup_status(os.path.join(partial_path, 'backup.json'), status)
+    os.rename(partial_path, os.path.join(directory, name))
+    prune_backups(directory, retention_count)
+    logger.info('Backup %s finished in %d s', name, status['finished_unix_time'] - status['started_unix_time'])
+    return status
+
+def prune_backups(directory, retention_count):
+    # Called with the backup lock held, so any .partial directory left is from
+    # a backup that died.
+    backups = completed_backups(directory)
+    for name in backups[:max(len(backups) - retention_count, 0)]:
+        shutil.rmtree(os.path.join(directory, name))
+    for name in os.listdir(directory):
+        if name.endswith('.partial'):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+def list_backups(directory):
+    backups = []
+    for name in sorted(os.listdir(directory)):
+        for status_name in ('backup.json', 'progress.json'):
+            try:
+                with open(os.path.join(directory, name, status_name)) as status_file:
+                    backups.append(json.load(status_file))
+                break
+            except (FileNotFoundError, NotADirectoryError, ValueError):
+                continue
+    return backups
+
+def run_scheduled_backups():
+    while True:
+        time.sleep(backup_check_interval_seconds)
+        try:
+            create_backup(db_name, picture_directory, backup_directory, interval_seconds=backup_interval_seconds)
+        except BackupInProgress:
+            continue
+        except Exception:
+            logger.exception('Scheduled backup failed')
+
+def start_backup_scheduler():
+    global backup_scheduler
+    if backup_directory is None or backup_interval_seconds <= 0:
+        return
+    backup_scheduler = threading.Thread(target=run_scheduled_backups, name='backup-scheduler', daemon=True)
+    backup_scheduler.start()
+
+def run_requested_backup():
+    try:
+        create_backup(db_name, picture_directory, backup_directory)
+    except BackupInProgress:
+        logger.warning('Requested backup skipped, another backup is running')
+    except Exception:
+        logger.exception('Requested backup failed')
+
+@app.route('/inventory/api/v1.0/backups', methods=['GET'])
+@check_auth_header
+def get_backups():
+    if backup_directory is None:
+        abort(404)
+    if not os.path.isdir(backup_directory):
+        return jsonify([])
+    return jsonify(list_backups(backup_directory))
+
+@app.route('/inventory/api/v1.0/backups', methods=['POST'])
+@check_auth_header
+def request_backup():
+    if backup_directory is None:
+        abort(404)
+    os.makedirs(backup_directory, exist_ok=True)
+    try:
+        backup_lock(backup_directory).close()
+    except BackupInProgress:
+        abort(409)
+    backup_executor.submit(run_requested_backup)
+    return '', 202, {'Location': '/inventory/api/v1.0/backups'}
+
+def configure(database, pictures, auth_path, backups=None):
+    global db_name, picture_directory, auth_value, backup_directory
+    db_name = database
+    picture_directory = pictures
+    backup_directory = backups
+    with open(auth_path, 'r') as auth_file:
+        auth_value = auth_file.read().strip().encode()
+    configure_logging()
+    migrate_db(db_name)
+    compact_change_log(db_name)
+    fail_interrupted_import_jobs(db_name)
+
+def reset_after_fork():
+    global connection_pool, group_commit_writer
+    connection_pool = None
+    group_commit_writer = None
+    configure_logging()
+    start_worker_metrics_writer()
+    start_backup_scheduler()
+
+def serve_production(args):
+    global metrics_directory
+    ssl_context = None if args.no_tls else (args.cert, args.key)
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        logger.warning('gunicorn is not installed, serving from a single multi-threaded process')
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        start_backup_scheduler()
+        app.run(host=args.host, port=args.port, threaded=True, ssl_context=ssl_context)
+        return
+
+    class ProductionApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{args.host}:{args.port}')
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('keepalive', args.keepalive)
+            self.cfg.set('graceful_timeout', args.graceful_timeout)
+            self.cfg.set('post_fork', lambda server, worker: reset_after_fork())
+            if ssl_context is not None:
+                self.cfg.set('certfile', args.cert)
+                self.cfg.set('keyfile', args.key)
+
+        def load(self):
+            return app
+
+    metrics_directory = tempfile.mkdtemp(prefix='inventory-metrics-')
+    try:
+        ProductionApplication().run()
+    finally:
+        shutil.rmtree(metrics_directory, ignore_errors=True)
+
 if __name__ == '__main__':
-    assert len(sys.argv) == 6
-    db_name = sys.argv[1]
-    picture_directory = sys.argv[2]
-    auth_value = open(sys.argv[3], 'r').read().strip()
-    cert=sys.argv[4]
-    key=sys.argv[5]
-    app.run(host='0.0.0.0', debug=True)
-    #app.run(host='0.0.0.0', debug=True, ssl_context=(cert, key))
+    parser = argparse.ArgumentParser(description='REST server for the InventoryScanner.')
+    parser.add_argument('db_name')
+    parser.add_argument('picture_directory')
+    parser.add_argument('auth_path')
+    parser.add_argument('cert')
+    parser.add_argument('key')
+    parser.add_argument('--production', action='store_true', help='Serve with a multi-worker WSGI server instead of the Flask debug server.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('INVENTORY_PORT', '5000')))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('INVENTORY_WORKERS', str(os.cpu_count() or 1))))
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('INVENTORY_THREADS', '8')))
+    parser.add_argument('--keepalive', type=int, default=int(os.environ.get('INVENTORY_KEEPALIVE_SECONDS', '5')))
+    parser.add_argument('--graceful-timeout', type=int, default=int(os.environ.get('INVENTORY_GRACEFUL_TIMEOUT_SECONDS', '30')))
+    parser.add_argument('--no-tls', action='store_true', help='Serve plain HTTP in production mode.')
+    parser.add_argument('--backup-directory', default=os.environ.get('INVENTORY_BACKUP_DIRECTORY'), help='Take scheduled online backups into this directory.')
+    args = parser.parse_args()
+    configure(args.db_name, args.picture_directory, args.auth_path, args.backup_directory)
+    if args.production:
+        serve_production(args)
+    else:
+        start_backup_scheduler()
+        app.run(host=args.host, port=args.port, debug=True)